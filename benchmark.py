@@ -0,0 +1,406 @@
+# Benchmark sin conexión del bot
+# Ejecuta los manejadores reales de main.py con actualizaciones sintéticas,
+# contra una hoja de cálculo en memoria (con latencia simulada por llamada) y
+# una API de Telegram falsa. Para cada tamaño de hoja informa la latencia
+# p50/p99 de cada acción, las acciones por segundo y las llamadas a Sheets
+# por acción, incluidas las escrituras por lotes del diario de altas y del
+# registro de usuarios.
+#
+#   python benchmark.py                          # 100, 1000, 10000 y 100000 filas
+#   python benchmark.py --filas 1000 --latencia 80 --usuarios 50
+#
+# Cada tamaño se mide en un proceso aparte para que las cachés de un tamaño
+# no contaminen al siguiente.
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import Counter
+from datetime import datetime, timedelta
+
+PALABRAS = (
+    "cocinero chofer custodio dependiente contador electricista albañil carpintero "
+    "recepcionista camarero programador enfermero limpieza mensajero bodeguero "
+    "mecanico plomero cajero almacenero panadero"
+).split()
+EMPRESAS = ["Mipyme El Sol", "Hotel Varadero", "Paladar Yumurí", "Taller Cárdenas", "Cooperativa Matanzas"]
+ESCOLARIDAD = ["9no grado", "12 grado", "Técnico medio", "Universitario"]
+
+def vocabulario(tamano: int) -> list:
+    # Oficios reales más oficios sintéticos: con un vocabulario pequeño cada
+    # oferta coincidiría con casi todos los candidatos y los avisos de
+    # /alerta dominarían la medida
+    return PALABRAS + [f"oficio{i}" for i in range(max(0, tamano - len(PALABRAS)))]
+
+# Google Sheets en memoria
+class HojaMemoria:
+    ids = itertools.count(1)
+
+    def __init__(self, titulo: str, filas: list, latencia: float, llamadas: Counter):
+        self.title = titulo
+        self.id = next(self.ids)
+        self.filas = filas
+        self.latencia = latencia
+        self.llamadas = llamadas
+        self._lock = threading.Lock()
+
+    def _llamada(self, operacion: str):
+        # Se ejecuta en los hilos de llamar_almacen, como la llamada HTTP real
+        self.llamadas[operacion] += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def get_all_values(self):
+        self._llamada("get_all_values")
+        with self._lock:
+            return [list(f) for f in self.filas]
+
+    def col_values(self, col: int):
+        self._llamada("col_values")
+        with self._lock:
+            return [f[col - 1] for f in self.filas if len(f) >= col]
+
+    def append_row(self, fila: list, **kwargs):
+        self.append_rows([fila])
+
+    def append_rows(self, filas: list, **kwargs):
+        self._llamada("append_rows")
+        with self._lock:
+            inicio = len(self.filas) + 1
+            self.filas.extend([str(v) for v in f] for f in filas)
+            return {"updates": {"updatedRange": f"'{self.title}'!A{inicio}:H{len(self.filas)}"}}
+
+    def batch_update(self, datos: list, **kwargs):
+        import gspread
+        self._llamada("batch_update")
+        with self._lock:
+            for dato in datos:
+                fila, col = gspread.utils.a1_to_rowcol(dato["range"].split(":")[0])
+                while len(self.filas) < fila:
+                    self.filas.append([])
+                destino = self.filas[fila - 1]
+                destino.extend([""] * (col - len(destino)))
+                destino[col - 1] = str(dato["values"][0][0])
+
+    def batch_get(self, rangos: list):
+        self._llamada("batch_get")
+        with self._lock:
+            bloques = []
+            for rango in rangos:
+                inicio, fin = (int(v) for v in rango.split(":"))
+                bloques.append([list(f) for f in self.filas[inicio - 1:fin]])
+            return bloques
+
+class LibroMemoria:
+    def __init__(self, hojas: dict, latencia: float, llamadas: Counter):
+        self.latencia = latencia
+        self.llamadas = llamadas
+        self.hojas = {nombre: HojaMemoria(nombre, filas, latencia, llamadas) for nombre, filas in hojas.items()}
+
+    def worksheet(self, nombre: str):
+        import gspread
+        if nombre not in self.hojas:
+            raise gspread.exceptions.WorksheetNotFound(nombre)
+        return self.hojas[nombre]
+
+    def add_worksheet(self, nombre: str, rows: int = 1, cols: int = 1):
+        self.hojas[nombre] = HojaMemoria(nombre, [], self.latencia, self.llamadas)
+        return self.hojas[nombre]
+
+    def batch_update(self, cuerpo: dict):
+        self.llamadas["borrar_filas"] += 1
+        for peticion in cuerpo["requests"]:
+            rango = peticion["deleteDimension"]["range"]
+            hoja = next(h for h in self.hojas.values() if h.id == rango["sheetId"])
+            with hoja._lock:
+                del hoja.filas[rango["startIndex"]:rango["endIndex"]]
+
+def generar_hojas(filas: int, palabras: list, aleatorio: random.Random) -> dict:
+    hoy = datetime.now()
+
+    def fecha():
+        return (hoy - timedelta(days=aleatorio.randrange(14))).strftime("%Y-%m-%d")
+
+    def texto(n):
+        return " ".join(aleatorio.choices(palabras, k=n))
+
+    ofertas = [["ID", "Puesto", "Empresa", "Salario", "Descripcion", "Contacto", "Fecha", "UserID"]] + [
+        [str(i), texto(2), aleatorio.choice(EMPRESAS), str(aleatorio.randrange(2000, 20000, 500)),
+         texto(12), f"+53 5{i:07d}", fecha(), str(10 ** 6 + i)]
+        for i in range(1, filas + 1)
+    ]
+    candidatos = [["ID", "Nombre", "Trabajo", "Escolaridad", "Contacto", "Fecha", "UserID"]] + [
+        [str(i), f"Candidato {i}", texto(1), aleatorio.choice(ESCOLARIDAD), f"+53 6{i:07d}", fecha(), str(2 * 10 ** 6 + i)]
+        for i in range(1, filas + 1)
+    ]
+    usuarios = [["UserID", "Nombre", "Username", "ChatID", "Fecha", "Mensajes", "Estado"]] + [
+        [str(3 * 10 ** 6 + i), f"Usuario {i}", f"@u{i}", str(3 * 10 ** 6 + i), fecha() + " 10:00:00", "0", "activo"]
+        for i in range(1, filas + 1)
+    ]
+    return {"Ofertas": ofertas, "Candidatos": candidatos, "Usuarios": usuarios, "Alertas": [["UserID", "Palabras", "Fecha"]]}
+
+# API de Telegram falsa
+def crear_peticion_falsa(latencia: float, enviados: Counter):
+    from telegram.request import BaseRequest
+
+    class PeticionFalsa(BaseRequest):
+        mensajes = itertools.count(1)
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        @property
+        def read_timeout(self):
+            return 5
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            metodo = url.rsplit("/", 1)[-1]
+            parametros = request_data.parameters if request_data else {}
+            enviados[metodo] += 1
+            if latencia:
+                await asyncio.sleep(latencia)
+            if metodo == "getMe":
+                resultado = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot"}
+            elif metodo.startswith(("send", "edit")):
+                resultado = {
+                    "message_id": next(self.mensajes), "date": int(time.time()),
+                    "chat": {"id": parametros.get("chat_id", 1), "type": "private"}, "text": ""
+                }
+            else:
+                resultado = True
+            return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+    return PeticionFalsa()
+
+# Actualizaciones sintéticas
+numeros = itertools.count(1)
+
+def mensaje(uid: int, texto: str) -> dict:
+    n = next(numeros)
+    entidades = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}] if texto.startswith("/") else []
+    return {"update_id": n, "message": {
+        "message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"u{uid}"},
+        "text": texto, "entities": entidades
+    }}
+
+def boton(uid: int, datos: str) -> dict:
+    n = next(numeros)
+    return {"update_id": n, "callback_query": {
+        "id": str(n), "chat_instance": str(uid), "data": datos,
+        "from": {"id": uid, "is_bot": False, "first_name": f"U{uid}"},
+        "message": {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "Bot"}, "text": "x"}
+    }}
+
+def escenarios(m, palabras: list, aleatorio: random.Random) -> dict:
+    # Cada acción es la secuencia de actualizaciones de un usuario
+    uids = itertools.count(5 * 10 ** 6)
+
+    def texto(n):
+        return " ".join(aleatorio.choices(palabras, k=n)) + f" {aleatorio.getrandbits(32):x}"
+
+    def start():
+        return [mensaje(next(uids), "/start")]
+
+    def buscar():
+        return [mensaje(next(uids), f"/buscar {aleatorio.choice(PALABRAS)}")]
+
+    def paginar():
+        version = m.cache_ofertas.version or 0
+        inicio = m.RESULTADOS_POR_PAGINA * aleatorio.randrange(1, 5)
+        return [boton(next(uids), f"pag:o:{version:x}:{inicio}:{aleatorio.choice(PALABRAS)}")]
+
+    def ver_mas():
+        return [boton(next(uids), aleatorio.choice(["ver_mas_ofertas", "ver_mas_candidatos"]))]
+
+    def oferta():
+        uid = next(uids)
+        return [boton(uid, "ofertar_trabajo")] + [
+            mensaje(uid, t) for t in (texto(2), aleatorio.choice(EMPRESAS), "5000", texto(14), "+53 50000000")
+        ]
+
+    def candidato():
+        uid = next(uids)
+        return [boton(uid, "registro_trabajador")] + [
+            mensaje(uid, t) for t in (f"Nombre {uid}", texto(1), aleatorio.choice(ESCOLARIDAD), "+53 60000000")
+        ]
+
+    return {
+        "start": start, "buscar": buscar, "paginar": paginar, "ver_mas": ver_mas,
+        "oferta": oferta, "candidato": candidato,
+    }
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))]
+
+async def esperar_segundo_plano():
+    # Avisos de /alerta y difusiones lanzados por los manejadores
+    actual = asyncio.current_task()
+    while any(t is not actual and not t.done() for t in asyncio.all_tasks()):
+        await asyncio.sleep(0.05)
+
+async def volcar(m):
+    # Las escrituras de altas y usuarios las hacen trabajos periódicos, que aquí
+    # no corren: se ejecutan tras cada acción para contar sus llamadas a Sheets
+    await m.drenar_diario(None)
+    await m.volcar_usuarios(None)
+
+async def medir(app, m, generar, acciones: int, usuarios: int, llamadas: Counter, enviados: Counter) -> dict:
+    from telegram import Update
+    latencias = []
+    pendientes = itertools.count()
+    antes = sum(llamadas.values())
+    mensajes = sum(enviados.values())
+
+    async def trabajador():
+        while next(pendientes) < acciones:
+            pasos = generar()
+            inicio = time.perf_counter()
+            for paso in pasos:
+                await app.process_update(Update.de_json(paso, app.bot))
+            # El usuario no espera a las escrituras en segundo plano: cuentan en
+            # Sheets/acc pero no en la latencia
+            latencias.append(time.perf_counter() - inicio)
+            await volcar(m)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(usuarios)))
+    duracion = time.perf_counter() - inicio
+    await esperar_segundo_plano()
+    return {
+        "acciones": len(latencias),
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p99_ms": percentil(latencias, 99) * 1000,
+        "por_segundo": len(latencias) / duracion if duracion else 0.0,
+        "sheets_por_accion": (sum(llamadas.values()) - antes) / max(len(latencias), 1),
+        "telegram_por_accion": (sum(enviados.values()) - mensajes) / max(len(latencias), 1),
+    }
+
+async def medir_difusion(app, m, llamadas: Counter, enviados: Counter) -> dict:
+    from telegram import Update
+    antes = sum(llamadas.values())
+    mensajes = sum(enviados.values())
+    inicio = time.perf_counter()
+    await app.process_update(Update.de_json(mensaje(m.ADMIN_IDS[0], "/enviar Mensaje de prueba"), app.bot))
+    respuesta = time.perf_counter() - inicio
+    while app.bot_data.get("difusion"):
+        await asyncio.sleep(0.05)
+    duracion = time.perf_counter() - inicio
+    await esperar_segundo_plano()
+    await volcar(m)
+    entregados = sum(enviados.values()) - mensajes
+    return {
+        "acciones": 1,
+        "p50_ms": respuesta * 1000,
+        "p99_ms": duracion * 1000,
+        "por_segundo": entregados / duracion if duracion else 0.0,
+        "sheets_por_accion": sum(llamadas.values()) - antes,
+        "telegram_por_accion": entregados,
+    }
+
+async def ejecutar(args) -> dict:
+    aleatorio = random.Random(args.semilla)
+    llamadas = Counter()
+    enviados = Counter()
+
+    # main.py lee la configuración al importarse
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+    os.environ["ALMACEN"] = "sheets"
+    # Sin límites por usuario ni de Telegram: se mide el coste del propio bot
+    os.environ["LIMITE_MENSAJES_USUARIO"] = "1000000"
+    os.environ["RAFAGA_MENSAJES_USUARIO"] = "1000000"
+    os.environ["LIMITE_ENVIOS_GLOBAL"] = "1000000"
+    os.environ["PUERTO_METRICAS"] = "0"
+    os.chdir(tempfile.mkdtemp(prefix="benchmark_empleo_"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as m
+    m.logger.setLevel("WARNING")
+    # La aplicación no se arranca (sin trabajos periódicos ni recepción de
+    # actualizaciones); las tareas que lanzan los manejadores se esperan en
+    # esperar_segundo_plano()
+    warnings.filterwarnings("ignore", message="Tasks created via `Application.create_task`")
+    m.limitador_envios.intervalo_chat = 0
+    palabras = vocabulario(args.vocabulario)
+    # El cliente de Sheets se conecta en el primer uso: basta con darle el libro
+    m.cliente_sheets.libro = LibroMemoria(generar_hojas(args.filas, palabras, aleatorio), args.latencia / 1000, llamadas)
+
+    app = m.crear_app(crear_peticion_falsa(args.latencia_telegram / 1000, enviados))
+    resultados = {}
+    async with app:
+        inicio = time.perf_counter()
+        antes = sum(llamadas.values())
+        await app.post_init(app)
+        duracion = (time.perf_counter() - inicio) * 1000
+        resultados["arranque"] = {
+            "acciones": 1, "p50_ms": duracion, "p99_ms": duracion, "por_segundo": 0.0,
+            "sheets_por_accion": sum(llamadas.values()) - antes, "telegram_por_accion": sum(enviados.values()),
+        }
+        for nombre, generar in escenarios(m, palabras, aleatorio).items():
+            resultados[nombre] = await medir(app, m, generar, args.acciones, args.usuarios, llamadas, enviados)
+        if args.difusion:
+            resultados["enviar"] = await medir_difusion(app, m, llamadas, enviados)
+    return resultados
+
+def imprimir(filas: int, resultados: dict):
+    print(f"\n== {filas} filas por hoja ==")
+    print(f"{'acción':<12}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}{'acc/s':>10}{'Sheets/acc':>12}{'Telegram/acc':>14}")
+    for nombre, r in resultados.items():
+        print(f"{nombre:<12}{r['acciones']:>6}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{r['por_segundo']:>10.1f}{r['sheets_por_accion']:>12.2f}{r['telegram_por_accion']:>14.1f}")
+    if "enviar" in resultados:
+        print("(enviar: p50 = respuesta al admin, p99 = difusión completa, acc/s = mensajes entregados por segundo)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sin conexión de los manejadores del bot")
+    parser.add_argument("--filas", type=int, nargs="+", default=[100, 1000, 10000, 100000],
+                        help="filas de cada hoja (Ofertas, Candidatos, Usuarios)")
+    parser.add_argument("--latencia", type=float, default=50, help="latencia simulada por llamada a Sheets, en ms")
+    parser.add_argument("--latencia-telegram", type=float, default=0, help="latencia simulada por llamada a Telegram, en ms")
+    parser.add_argument("--usuarios", type=int, default=20, help="usuarios simultáneos")
+    parser.add_argument("--acciones", type=int, default=200, help="acciones por escenario")
+    parser.add_argument("--vocabulario", type=int, default=2000, help="oficios distintos en los datos generados")
+    parser.add_argument("--sin-difusion", dest="difusion", action="store_false", help="no medir /enviar")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="salida en JSON (uso interno)")
+    args = parser.parse_args()
+
+    if len(args.filas) > 1:
+        # Un proceso por tamaño
+        for filas in args.filas:
+            orden = [sys.executable, os.path.abspath(__file__), "--json", "--filas", str(filas)]
+            for opcion in ("latencia", "latencia_telegram", "usuarios", "acciones", "vocabulario", "semilla"):
+                orden += [f"--{opcion.replace('_', '-')}", str(getattr(args, opcion))]
+            if not args.difusion:
+                orden.append("--sin-difusion")
+            salida = subprocess.run(orden, capture_output=True, text=True)
+            if salida.returncode != 0:
+                print(f"\n== {filas} filas por hoja: error ==\n{salida.stderr[-2000:]}")
+                continue
+            imprimir(filas, json.loads(salida.stdout.strip().splitlines()[-1]))
+        return
+
+    args.filas = args.filas[0]
+    resultados = asyncio.run(ejecutar(args))
+    if args.json:
+        print(json.dumps(resultados))
+    else:
+        imprimir(args.filas, resultados)
+
+if __name__ == "__main__":
+    main()
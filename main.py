@@ -1,20 +1,58 @@
 import os
 import json
+import argparse
+import asyncio
+import bisect
+import contextlib
+import copy
+import csv
+import fcntl
+import functools
+import itertools
 import logging
+import math
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackContext,
     CallbackQueryHandler,
     MessageHandler,
     filters,
-    ConversationHandler
+    ConversationHandler,
+    InlineQueryHandler,
+    PersistenceInput,
+    TypeHandler
 )
 import gspread
+import numpy as np
+import uvicorn
 from google.oauth2.service_account import Credentials
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
 
 # Configuración de logging
 logging.basicConfig(
@@ -26,74 +64,1504 @@ logger = logging.getLogger(__name__)
 # Constantes
 ADMIN_IDS = [8046846584]  # Reemplaza con tu ID real
 PALABRAS_PROHIBIDAS = {"singar", "fraude", "spam", "http://", "https://"}
-ULTIMOS_MENSAJES = {}
+ULTIMOS_MENSAJES = OrderedDict()  # user_id -> [tokens, última vez, avisado], el más antiguo primero
+MAX_USUARIOS_LIMITADOS = 20000
+LIMITE_MENSAJES_USUARIO = float(os.getenv('LIMITE_MENSAJES_USUARIO', '1'))  # Mensajes por segundo
+RAFAGA_MENSAJES_USUARIO = int(os.getenv('RAFAGA_MENSAJES_USUARIO', '8'))
 PUESTO, EMPRESA, SALARIO, DESCRIPCION, CONTACTO = range(5)
 NOMBRE, TRABAJO, ESCOLARIDAD, CONTACTO_TRABAJADOR = range(4)
 RESULTADOS_POR_PAGINA = 3
+RESULTADOS_ORDENADOS = 5 * RESULTADOS_POR_PAGINA + 1  # Se ordenan de entrada; más si se piden páginas posteriores
+MAX_MIS_OFERTAS = 10  # Ofertas propias listadas en /misofertas
+RESULTADOS_INLINE = 20  # Telegram admite hasta 50 por respuesta
+CACHE_INLINE = 60  # Segundos que Telegram guarda cada respuesta inline
+RETARDO_INLINE = 0.3  # Espera antes de responder, por si el usuario sigue escribiendo
+UMBRAL_DUPLICADO = float(os.getenv('UMBRAL_DUPLICADO', '0.8'))  # Similitud a partir de la cual se rechaza
+ALERTAS_SILENCIADAS = "-"  # Palabras guardadas para quien desactiva los avisos
+PAGINAS_EN_CACHE = 1000  # Páginas ya renderizadas que se guardan en memoria
+CACHE_TTL = int(os.getenv('CACHE_TTL', '300'))  # Segundos antes de volver a leer una hoja
+SHEETS_MAX_HILOS = int(os.getenv('SHEETS_MAX_HILOS', '4'))  # Llamadas simultáneas a Sheets
+SHEETS_TIMEOUT = float(os.getenv('SHEETS_TIMEOUT', '20'))  # Segundos máximos por llamada
+RECONEXION_MAXIMA = 300  # Segundos máximos entre intentos de conexión con Sheets
+ACTUALIZACIONES_SIMULTANEAS = int(os.getenv('ACTUALIZACIONES_SIMULTANEAS', '16'))
+LIMITE_ENVIOS_GLOBAL = float(os.getenv('LIMITE_ENVIOS_GLOBAL', '25'))  # Mensajes por segundo
+ENVIOS_SIMULTANEOS = int(os.getenv('ENVIOS_SIMULTANEOS', '8'))
+INTERVALO_PROGRESO_ENVIO = 5  # Segundos entre actualizaciones del progreso
+INTERVALO_VOLCADO_USUARIOS = int(os.getenv('INTERVALO_VOLCADO_USUARIOS', '30'))
+DIAS_VIGENCIA_OFERTAS = 15
+INTERVALO_CADUCIDAD = int(os.getenv('INTERVALO_CADUCIDAD', str(6 * 3600)))  # Segundos entre revisiones
+HOJA_ARCHIVO = "OfertasArchivadas"
+ARCHIVO_LOCAL_OFERTAS = os.getenv('ARCHIVO_LOCAL_OFERTAS', 'ofertas_archivadas.jsonl')
+ALMACEN = os.getenv('ALMACEN', 'sheets')  # "sheets" o "sqlite"
+RUTA_SQLITE = os.getenv('RUTA_SQLITE', 'empleo.db')
+INTERVALO_REPLICACION = int(os.getenv('INTERVALO_REPLICACION', '15'))  # Segundos entre envíos a Sheets
+DIARIO_ALTAS = os.getenv('DIARIO_ALTAS', 'altas_pendientes.jsonl')
+RUTA_PERSISTENCIA = os.getenv('RUTA_PERSISTENCIA', 'estado_bot.db')  # Conversaciones a medias y user_data
+INTERVALO_PERSISTENCIA = int(os.getenv('INTERVALO_PERSISTENCIA', '10'))  # Segundos entre volcados
+INTERVALO_DIARIO = 5  # Segundos entre volcados del diario de altas
+DIARIO_ESPERA_MAXIMA = 300
+DIARIO_MAX_LOTE = 500
+LOTE_IMPORTACION = 500  # Filas por cada append_rows al importar
+PAGINA_EXPORTACION = 1000  # Filas leídas por llamada al exportar
+MAX_ERRORES_IMPORTACION = 10  # Filas rechazadas que se detallan en el resumen
+
+# Modo de ejecución: "polling" (por defecto) o "webhook"
+MODO = os.getenv('MODO', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # URL pública, p. ej. https://mi-bot.example.com
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+RUTA_WEBHOOK = os.getenv('RUTA_WEBHOOK', 'telegram')
+PUERTO = int(os.getenv('PORT', '8080'))
+REPLICA = int(os.getenv('REPLICA', '0'))  # 0-99, distinto en cada réplica que comparta las hojas
+
+# Métricas en formato Prometheus, servidas solo en local
+HOST_METRICAS = os.getenv('HOST_METRICAS', '127.0.0.1')
+PUERTO_METRICAS = int(os.getenv('PUERTO_METRICAS', '9100'))  # 0 para desactivarlas
+PERFIL_LENTO_MS = float(os.getenv('PERFIL_LENTO_MS', '0'))  # Umbral del perfilador; 0 lo desactiva
 
 # Conexión con Google Sheets
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
-sheet = None
 ofertas_db = None
 usuarios_db = None
 candidatos_db = None
 
+# La conexión no se abre al importar: se abre en el arranque (post_init) o en
+# el primer uso. Si falla, los siguientes usos reintentan con espera
+# exponencial; si Google rechaza la sesión o una hoja deja de existir, se
+# descartan y se vuelven a abrir en la siguiente llamada.
+class ClienteSheets:
+    def __init__(self, nombre: str):
+        self.nombre = nombre
+        self.libro = None
+        self.hojas = {}
+        self.fallos = 0
+        self.reintento = 0.0
+        self._lock = threading.Lock()
+
+    def _credenciales(self):
+        creds_json = os.getenv('GOOGLE_CREDS_JSON')
+        if creds_json:
+            return Credentials.from_service_account_info(json.loads(creds_json), scopes=SCOPES)
+        return Credentials.from_service_account_file('credenciales.json', scopes=SCOPES)
+
+    def obtener_libro(self):
+        with self._lock:
+            if self.libro is not None:
+                return self.libro
+            espera = self.reintento - time.monotonic()
+            if espera > 0:
+                raise ConnectionError(f"Google Sheets no disponible, próximo intento en {espera:.0f} s")
+            try:
+                logger.info("Conectando con Google Sheets...")
+                self.libro = gspread.authorize(self._credenciales()).open(self.nombre)
+            except Exception as e:
+                self.fallos += 1
+                self.reintento = time.monotonic() + min(RECONEXION_MAXIMA, 2 ** self.fallos)
+                logger.error(f"Error conectando con Google Sheets (intento {self.fallos}): {e}")
+                raise
+            self.fallos = 0
+            self.hojas = {}
+            logger.info("Conexión exitosa con Google Sheets")
+            return self.libro
+
+    def hoja(self, nombre: str, crear: bool = False):
+        libro = self.obtener_libro()
+        with self._lock:
+            hoja = self.hojas.get(nombre)
+        if hoja is None:
+            try:
+                hoja = libro.worksheet(nombre)
+            except gspread.exceptions.WorksheetNotFound:
+                if not crear:
+                    raise
+                encabezados = ENCABEZADOS[nombre]
+                hoja = libro.add_worksheet(nombre, rows=1, cols=len(encabezados))
+                hoja.append_row(encabezados)
+            with self._lock:
+                self.hojas[nombre] = hoja
+        return hoja
+
+    def fallo(self, nombre: str, error: gspread.exceptions.APIError):
+        codigo = getattr(error.response, "status_code", None)
+        with self._lock:
+            if codigo == 401:
+                logger.warning("Sesión de Google Sheets rechazada, se reconectará")
+                self.libro = None
+                self.hojas = {}
+            elif codigo in (400, 404):
+                # La hoja pudo borrarse o recrearse: pedirla de nuevo
+                self.hojas.pop(nombre, None)
+
+cliente_sheets = ClienteSheets("EmpleoMatanzasDB")
+
+# Almacenamiento
+# Todas las funciones trabajan con "tablas" que se comportan como una hoja:
+# la fila 1 son los encabezados y los datos empiezan en la fila 2. Hay dos
+# implementaciones, elegidas con ALMACEN:
+#   - "sheets": Google Sheets directamente (modo original)
+#   - "sqlite": SQLite local como base principal; los cambios se replican
+#     por lotes a Sheets para que los administradores sigan usando la hoja
+ENCABEZADOS = {
+    "Ofertas": ["ID", "Puesto", "Empresa", "Salario", "Descripcion", "Contacto", "Fecha", "UserID"],
+    "Candidatos": ["ID", "Nombre", "Trabajo", "Escolaridad", "Contacto", "Fecha", "UserID"],
+    "Usuarios": ["UserID", "Nombre", "Username", "ChatID", "Fecha", "Mensajes", "Estado"],
+    "Alertas": ["UserID", "Palabras", "Fecha"],
+}
+ENCABEZADOS[HOJA_ARCHIVO] = ENCABEZADOS["Ofertas"]
+# Columnas de SQLite (en el orden de la hoja) y las que llevan índice
+COLUMNAS_SQLITE = {
+    "Ofertas": ["id", "puesto", "empresa", "salario", "descripcion", "contacto", "fecha", "user_id"],
+    "Candidatos": ["id", "nombre", "trabajo", "escolaridad", "contacto", "fecha", "user_id"],
+    "Usuarios": ["user_id", "nombre", "username", "chat_id", "fecha", "mensajes", "estado"],
+    "Alertas": ["user_id", "palabras", "fecha"],
+}
+COLUMNAS_SQLITE[HOJA_ARCHIVO] = COLUMNAS_SQLITE["Ofertas"]
+INDICES_SQLITE = {
+    "Ofertas": ["user_id", "fecha"],
+    "Candidatos": ["user_id", "fecha"],
+    "Usuarios": ["user_id", "chat_id"],
+    "Alertas": ["user_id"],
+}
+
+class TablaSheets:
+    # La hoja se resuelve en cada llamada a través del cliente, que la abre o
+    # la vuelve a abrir si hace falta
+    def __init__(self, cliente: ClienteSheets, nombre: str, crear: bool = False):
+        self.cliente = cliente
+        self.titulo = nombre
+        self.crear = crear
+
+    def _llamar(self, operacion):
+        hoja = self.cliente.hoja(self.titulo, self.crear)
+        try:
+            return operacion(hoja)
+        except gspread.exceptions.APIError as e:
+            self.cliente.fallo(self.titulo, e)
+            raise
+
+    def leer_todo(self) -> list:
+        return self._llamar(lambda hoja: hoja.get_all_values())
+
+    def columna(self, col: int) -> list:
+        return self._llamar(lambda hoja: hoja.col_values(col))
+
+    def agregar_filas(self, filas: list):
+        # Devuelve el número de la primera fila escrita, si la API lo informa
+        respuesta = self._llamar(lambda hoja: hoja.append_rows(filas))
+        rango = re.search(r"![A-Z]+(\d+)", (respuesta or {}).get('updates', {}).get('updatedRange', ''))
+        return int(rango.group(1)) if rango else None
+
+    def actualizar_celdas(self, celdas: list):
+        self._llamar(lambda hoja: hoja.batch_update([
+            {'range': gspread.utils.rowcol_to_a1(fila, col), 'values': [[valor]]}
+            for fila, col, valor in celdas
+        ]))
+
+    def leer_rangos(self, rangos: list) -> list:
+        bloques = self._llamar(lambda hoja: hoja.batch_get([f"{inicio}:{fin}" for inicio, fin in rangos]))
+        return [fila for bloque in bloques for fila in bloque]
+
+    def borrar_rangos(self, rangos: list):
+        # Un solo batch_update; de abajo hacia arriba para no desplazar los rangos
+        self._llamar(lambda hoja: self.cliente.obtener_libro().batch_update({"requests": [
+            {"deleteDimension": {"range": {
+                "sheetId": hoja.id,
+                "dimension": "ROWS",
+                "startIndex": inicio - 1,
+                "endIndex": fin
+            }}}
+            for inicio, fin in sorted(rangos, reverse=True)
+        ]}))
+
+    def borrar_donde(self, col: int, valor: str) -> int:
+        # Localizar y borrar en la misma llamada al hilo, sin ceder el control
+        # entre medias; quien llama debe serializar las escrituras en la tabla
+        filas = [n for n, v in enumerate(self.columna(col)[1:], start=2) if v == valor]
+        if filas:
+            self.borrar_rangos(agrupar_filas(filas))
+        return len(filas)
+
+class AlmacenSheets:
+    def __init__(self, cliente: ClienteSheets):
+        self.cliente = cliente
+        self.tablas = {}
+
+    def tabla(self, nombre: str, crear: bool = False) -> TablaSheets:
+        # No toca la red: la hoja se abre (o se crea) en la primera operación
+        if nombre not in self.tablas:
+            self.tablas[nombre] = TablaSheets(self.cliente, nombre, crear)
+        self.tablas[nombre].crear |= crear
+        return self.tablas[nombre]
+
+class TablaSQLite:
+    # La columna "fila" guarda la posición que la fila tendría en la hoja,
+    # así las operaciones por número de fila usan un índice
+    def __init__(self, almacen, nombre: str, crear: bool = False):
+        self.almacen = almacen
+        self.titulo = nombre
+        self.crear = crear
+        self.sql = '"' + nombre.lower() + '"'
+        self.columnas = COLUMNAS_SQLITE[nombre]
+
+    def _preparar(self):
+        # La tabla se crea (y se copia de Sheets) en la primera operación
+        if self.titulo not in self.almacen.encabezados:
+            with self.almacen.creando:
+                if self.titulo not in self.almacen.encabezados:
+                    self.almacen._crear(self, self.crear)
+
+    def _encabezados(self) -> list:
+        return self.almacen.encabezados[self.titulo]
+
+    def leer_todo(self) -> list:
+        self._preparar()
+        with self.almacen.lock:
+            filas = self.almacen.conn.execute(
+                f"SELECT {', '.join(self.columnas)} FROM {self.sql} ORDER BY fila"
+            ).fetchall()
+        return [self._encabezados()] + [list(f) for f in filas]
+
+    def columna(self, col: int) -> list:
+        self._preparar()
+        with self.almacen.lock:
+            valores = self.almacen.conn.execute(
+                f"SELECT {self.columnas[col - 1]} FROM {self.sql} ORDER BY fila"
+            ).fetchall()
+        return [self._encabezados()[col - 1]] + [v[0] for v in valores]
+
+    def _normalizar(self, fila: list) -> list:
+        fila = [str(v) for v in fila][:len(self.columnas)]
+        return fila + [""] * (len(self.columnas) - len(fila))
+
+    def agregar_filas(self, filas: list, replicar: bool = True):
+        self._preparar()
+        filas = [self._normalizar(f) for f in filas]
+        with self.almacen.transaccion() as conn:
+            primera = conn.execute(f"SELECT COALESCE(MAX(fila), 1) + 1 FROM {self.sql}").fetchone()[0]
+            conn.executemany(
+                f"INSERT INTO {self.sql} (fila, {', '.join(self.columnas)}) "
+                f"VALUES ({', '.join('?' * (len(self.columnas) + 1))})",
+                [[primera + i] + f for i, f in enumerate(filas)]
+            )
+            if replicar:
+                self.almacen.encolar(conn, self.titulo, "agregar", filas)
+        return primera
+
+    def actualizar_celdas(self, celdas: list):
+        self._preparar()
+        with self.almacen.transaccion() as conn:
+            for fila, col, valor in celdas:
+                conn.execute(f"UPDATE {self.sql} SET {self.columnas[col - 1]} = ? WHERE fila = ?", (str(valor), fila))
+            self.almacen.encolar(conn, self.titulo, "actualizar", celdas)
+
+    def leer_rangos(self, rangos: list) -> list:
+        self._preparar()
+        filas = []
+        with self.almacen.lock:
+            for inicio, fin in rangos:
+                filas.extend(list(f) for f in self.almacen.conn.execute(
+                    f"SELECT {', '.join(self.columnas)} FROM {self.sql} WHERE fila BETWEEN ? AND ? ORDER BY fila",
+                    (inicio, fin)
+                ))
+        return filas
+
+    def _borrar(self, conn, rangos: list):
+        for inicio, fin in sorted(rangos, reverse=True):
+            conn.execute(f"DELETE FROM {self.sql} WHERE fila BETWEEN ? AND ?", (inicio, fin))
+            conn.execute(f"UPDATE {self.sql} SET fila = fila - ? WHERE fila > ?", (fin - inicio + 1, fin))
+        self.almacen.encolar(conn, self.titulo, "borrar", rangos)
+
+    def borrar_rangos(self, rangos: list):
+        self._preparar()
+        with self.almacen.transaccion() as conn:
+            self._borrar(conn, rangos)
+
+    def borrar_donde(self, col: int, valor: str) -> int:
+        # Búsqueda y borrado en la misma transacción
+        self._preparar()
+        with self.almacen.transaccion() as conn:
+            filas = [f for (f,) in conn.execute(
+                f"SELECT fila FROM {self.sql} WHERE {self.columnas[col - 1]} = ?", (valor,)
+            )]
+            if filas:
+                self._borrar(conn, agrupar_filas(filas))
+        return len(filas)
+
+class AlmacenSQLite:
+    def __init__(self, ruta: str, espejo: AlmacenSheets = None):
+        self.espejo = espejo
+        self.lock = threading.Lock()
+        self.creando = threading.Lock()
+        self.replicando = threading.Lock()
+        self.conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tablas (nombre TEXT PRIMARY KEY, encabezados TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS replicacion (id INTEGER PRIMARY KEY, tabla TEXT, op TEXT, datos TEXT)"
+        )
+        self.encabezados = {
+            nombre: json.loads(encabezados)
+            for nombre, encabezados in self.conn.execute("SELECT nombre, encabezados FROM tablas")
+        }
+        self.tablas = {}
+
+    @contextlib.contextmanager
+    def transaccion(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def encolar(self, conn, tabla: str, op: str, datos: list):
+        # En la misma transacción que el cambio: nada se pierde si el proceso cae
+        conn.execute(
+                "INSERT INTO replicacion (tabla, op, datos) VALUES (?, ?, ?)",
+                (tabla, op, json.dumps(datos, ensure_ascii=False))
+            )
+
+    def tabla(self, nombre: str, crear: bool = False) -> TablaSQLite:
+        if nombre not in self.tablas:
+            self.tablas[nombre] = TablaSQLite(self, nombre, crear)
+        self.tablas[nombre].crear |= crear
+        return self.tablas[nombre]
+
+    def _crear(self, tabla: TablaSQLite, crear: bool):
+        # Primera vez: crear la tabla y copiar lo que ya hay en la hoja
+        valores = []
+        if self.espejo:
+            try:
+                valores = self.espejo.tabla(tabla.titulo, crear=crear).leer_todo()
+            except gspread.exceptions.WorksheetNotFound:
+                pass
+        encabezados = valores[0] if valores else ENCABEZADOS[tabla.titulo]
+        with self.transaccion() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {tabla.sql} "
+                f"(fila INTEGER NOT NULL, {', '.join(c + ' TEXT' for c in tabla.columnas)})"
+            )
+            conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS \"idx_{tabla.titulo.lower()}_fila\" ON {tabla.sql} (fila)")
+            for columna in INDICES_SQLITE.get(tabla.titulo, []):
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS \"idx_{tabla.titulo.lower()}_{columna}\" ON {tabla.sql} ({columna})"
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO tablas (nombre, encabezados) VALUES (?, ?)",
+                (tabla.titulo, json.dumps(encabezados, ensure_ascii=False))
+            )
+        self.encabezados[tabla.titulo] = encabezados
+        if len(valores) > 1:
+            tabla.agregar_filas(valores[1:], replicar=False)
+        logger.info(f"Tabla SQLite '{tabla.titulo}' creada con {max(len(valores) - 1, 0)} filas de Sheets")
+
+    def replicar(self, limite: int = 500) -> int:
+        # Aplicar a Sheets el primer lote de cambios pendientes: las altas y
+        # actualizaciones consecutivas de una misma tabla van en una sola
+        # llamada. Una llamada a Sheets por vez, para que cada una tenga su
+        # propio timeout; quien llama repite hasta que devuelve 0.
+        if not self.espejo:
+            return 0
+        # Si un timeout dejó otra réplica en marcha en su hilo, no leer las
+        # mismas filas a la vez: se enviarían dos veces
+        if not self.replicando.acquire(blocking=False):
+            return 0
+        try:
+            with self.lock:
+                pendientes = self.conn.execute(
+                    "SELECT id, tabla, op, datos FROM replicacion ORDER BY id LIMIT ?", (limite,)
+                ).fetchall()
+            lote = None
+            for id_, tabla, op, datos in pendientes:
+                if lote and not (lote[1] == tabla and lote[2] == op and op != "borrar"):
+                    break
+                if lote:
+                    lote[0] = id_
+                    lote[3].extend(json.loads(datos))
+                else:
+                    lote = [id_, tabla, op, json.loads(datos)]
+            if not lote:
+                return 0
+            ultimo_id, tabla, op, datos = lote
+            destino = self.espejo.tabla(tabla, crear=True)
+            if op == "agregar":
+                destino.agregar_filas(datos)
+            elif op == "actualizar":
+                destino.actualizar_celdas(datos)
+            elif op == "borrar":
+                destino.borrar_rangos(datos)
+            with self.lock:
+                return self.conn.execute("DELETE FROM replicacion WHERE id <= ?", (ultimo_id,)).rowcount
+        finally:
+            self.replicando.release()
+
+almacen = None
 try:
-    logger.info("Conectando con Google Sheets...")
-    creds_json = os.getenv('GOOGLE_CREDS_JSON')
-    if creds_json:
-        creds_dict = json.loads(creds_json)
-        CREDS = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-    else:
-        CREDS = Credentials.from_service_account_file('credenciales.json', scopes=SCOPES)
-    
-    client = gspread.authorize(CREDS)
-    sheet = client.open("EmpleoMatanzasDB")
-    ofertas_db = sheet.worksheet("Ofertas")
-    usuarios_db = sheet.worksheet("Usuarios")
-    candidatos_db = sheet.worksheet("Candidatos")
-    logger.info("Conexión exitosa con Google Sheets")
+    espejo = AlmacenSheets(cliente_sheets)
+    almacen = AlmacenSQLite(RUTA_SQLITE, espejo) if ALMACEN == "sqlite" else espejo
+    ofertas_db = almacen.tabla("Ofertas")
+    usuarios_db = almacen.tabla("Usuarios")
+    candidatos_db = almacen.tabla("Candidatos")
 except Exception as e:
-    logger.error(f"Error conectando con Google Sheets: {e}")
+    logger.error(f"Error abriendo el almacenamiento '{ALMACEN}': {e}")
+
+# Métricas
+# Registro mínimo en el formato de texto de Prometheus. Todas las
+# observaciones se hacen desde el event loop, así que bastan unas pocas
+# operaciones de diccionario por llamada, sin locks.
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metricas:
+    def __init__(self):
+        self.contadores = defaultdict(float)  # (nombre, etiquetas) -> valor
+        self.histogramas = {}  # (nombre, etiquetas) -> [cuentas por cubeta, suma]
+        self.indicadores = {}  # nombre -> función que devuelve [(etiquetas, valor)]
+        self.ayudas = {}
+
+    def describir(self, nombre: str, tipo: str, ayuda: str):
+        self.ayudas[nombre] = (tipo, ayuda)
+
+    def contar(self, nombre: str, valor: float = 1, **etiquetas):
+        self.contadores[(nombre, tuple(etiquetas.items()))] += valor
+
+    def observar(self, nombre: str, segundos: float, **etiquetas):
+        clave = (nombre, tuple(etiquetas.items()))
+        histograma = self.histogramas.get(clave)
+        if histograma is None:
+            histograma = self.histogramas[clave] = [[0] * (len(CUBETAS_SEGUNDOS) + 1), 0.0]
+        histograma[0][bisect.bisect_left(CUBETAS_SEGUNDOS, segundos)] += 1
+        histograma[1] += segundos
+
+    def indicador(self, nombre: str, ayuda: str, funcion):
+        self.describir(nombre, "gauge", ayuda)
+        self.indicadores[nombre] = funcion
+
+    @staticmethod
+    def _etiquetas(etiquetas, extra: tuple = ()) -> str:
+        pares = [
+            f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for k, v in tuple(etiquetas) + extra
+        ]
+        return "{" + ",".join(pares) + "}" if pares else ""
+
+    def exportar(self) -> str:
+        series = defaultdict(list)
+        for (nombre, etiquetas), valor in self.contadores.items():
+            series[nombre].append(f"{nombre}{self._etiquetas(etiquetas)} {valor:g}")
+        for (nombre, etiquetas), (cuentas, suma) in self.histogramas.items():
+            acumulado = 0
+            for limite, cuenta in zip(CUBETAS_SEGUNDOS + ("+Inf",), cuentas):
+                acumulado += cuenta
+                series[nombre].append(f"{nombre}_bucket{self._etiquetas(etiquetas, (('le', limite),))} {acumulado}")
+            series[nombre].append(f"{nombre}_sum{self._etiquetas(etiquetas)} {suma:g}")
+            series[nombre].append(f"{nombre}_count{self._etiquetas(etiquetas)} {acumulado}")
+        for nombre, funcion in self.indicadores.items():
+            try:
+                for etiquetas, valor in funcion():
+                    series[nombre].append(f"{nombre}{self._etiquetas(etiquetas.items())} {valor:g}")
+            except Exception as e:
+                logger.error(f"Error calculando la métrica {nombre}: {e}")
+        lineas = []
+        for nombre in sorted(series):
+            if nombre in self.ayudas:
+                tipo, ayuda = self.ayudas[nombre]
+                lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"]
+            lineas += series[nombre]
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+metricas.describir("empleo_manejador_segundos", "histogram", "Duración de cada manejador de Telegram")
+metricas.describir("empleo_manejador_errores_total", "counter", "Excepciones no capturadas por manejador")
+metricas.describir("empleo_almacen_segundos", "histogram", "Duración de las llamadas al almacenamiento por operación")
+metricas.describir("empleo_almacen_llamadas_total", "counter", "Llamadas al almacenamiento por operación, tabla y resultado")
+metricas.describir("empleo_cache_total", "counter", "Consultas a las cachés en memoria por resultado")
+metricas.describir("empleo_envios_total", "counter", "Mensajes de difusión y avisos por resultado")
+metricas.describir("empleo_bloqueos_loop_total", "counter", "Veces que el event loop estuvo bloqueado más del umbral")
+
+# Perfilador de manejadores lentos
+# Opcional (PERFIL_LENTO_MS > 0). Avisa de cada manejador que tarda más que el
+# umbral y, desde un hilo aparte, muestrea la pila del event loop cuando lleva
+# más de ese tiempo sin avanzar, es decir, cuando hay código bloqueante; al
+# recuperarse registra la pila más repetida.
+class PerfiladorLento:
+    def __init__(self, umbral_ms: float, intervalo: float = 0.005):
+        self.umbral = umbral_ms / 1000
+        self.intervalo = intervalo
+        self.latido = time.monotonic()
+        self.hilo_loop = None
+        self.loop = None
+        self._tarea = None
+
+    async def _latir(self):
+        while True:
+            self.latido = time.monotonic()
+            await asyncio.sleep(self.umbral / 2)
+
+    def iniciar(self):
+        if not self.umbral or self.hilo_loop:
+            return
+        self.hilo_loop = threading.get_ident()
+        self.loop = asyncio.get_running_loop()
+        self._tarea = asyncio.create_task(self._latir())
+        threading.Thread(target=self._muestrear, name="perfilador", daemon=True).start()
+        logger.info(f"Perfilador activado: umbral {self.umbral * 1000:.0f} ms")
+
+    def _muestrear(self):
+        muestras = Counter()
+        while True:
+            time.sleep(self.intervalo)
+            if time.monotonic() - self.latido > self.umbral:
+                marco = sys._current_frames().get(self.hilo_loop)
+                if marco is not None:
+                    muestras["".join(traceback.format_stack(marco, limit=10))] += 1
+            elif muestras:
+                pila, veces = muestras.most_common(1)[0]
+                bloqueo = self.umbral + sum(muestras.values()) * self.intervalo
+                logger.warning(f"Event loop bloqueado unos {bloqueo * 1000:.0f} ms; pila más frecuente ({veces} muestras):\n{pila}")
+                # Las métricas solo se tocan desde el event loop (que puede
+                # haberse cerrado ya al apagar el bot)
+                with contextlib.suppress(RuntimeError):
+                    self.loop.call_soon_threadsafe(metricas.contar, "empleo_bloqueos_loop_total")
+                muestras.clear()
+
+perfilador = PerfiladorLento(PERFIL_LENTO_MS)
+
+def medir_manejador(funcion):
+    nombre = funcion.__name__
+
+    @functools.wraps(funcion)
+    async def medido(update, context):
+        inicio = time.perf_counter()
+        try:
+            return await funcion(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            metricas.contar("empleo_manejador_errores_total", manejador=nombre)
+            raise
+        finally:
+            duracion = time.perf_counter() - inicio
+            metricas.observar("empleo_manejador_segundos", duracion, manejador=nombre)
+            if perfilador.umbral and duracion > perfilador.umbral:
+                logger.warning(f"Manejador lento: {nombre} tardó {duracion * 1000:.0f} ms")
+    return medido
+
+def instrumentar(handler):
+    # Envolver los callbacks ya registrados, también los de las conversaciones
+    if isinstance(handler, ConversationHandler):
+        for interno in handler.entry_points + [h for hs in handler.states.values() for h in hs] + handler.fallbacks:
+            instrumentar(interno)
+    else:
+        handler.callback = medir_manejador(handler.callback)
+
+# Acceso al almacenamiento fuera del event loop
+# gspread y sqlite3 son síncronos: cada llamada se ejecuta en un pool de hilos
+# acotado, con un límite de concurrencia y un timeout para no congelar al bot.
+executor_almacen = ThreadPoolExecutor(max_workers=SHEETS_MAX_HILOS, thread_name_prefix="almacen")
+limite_almacen = asyncio.Semaphore(SHEETS_MAX_HILOS)
+
+async def llamar_almacen(funcion, *args, **kwargs):
+    operacion = getattr(funcion, "__name__", "otra")
+    tabla = getattr(getattr(getattr(funcion, "__wrapped__", funcion), "__self__", None), "titulo", "")
+    resultado = "ok"
+    inicio = time.perf_counter()
+    try:
+        async with limite_almacen:
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(
+                loop.run_in_executor(executor_almacen, functools.partial(funcion, *args, **kwargs)),
+                timeout=SHEETS_TIMEOUT
+            )
+    except Exception:
+        resultado = "error"
+        raise
+    finally:
+        metricas.observar("empleo_almacen_segundos", time.perf_counter() - inicio, operacion=operacion)
+        metricas.contar("empleo_almacen_llamadas_total", operacion=operacion, tabla=tabla, resultado=resultado)
+
+# Búsqueda por palabras
+PALABRAS_VACIAS = {
+    "de", "la", "el", "en", "y", "a", "los", "las", "del", "para", "con", "por",
+    "un", "una", "se", "que", "o", "al", "su", "sus", "es", "lo", "como"
+}
+
+def normalizar(texto: str) -> str:
+    # Minúsculas y sin tildes: "Técnico" y "tecnico" son la misma palabra
+    texto = unicodedata.normalize("NFD", str(texto).lower())
+    return "".join(c for c in texto if unicodedata.category(c) != "Mn")
+
+def tokenizar(texto: str) -> list:
+    return [t for t in re.findall(r"[a-z0-9]+", normalizar(texto)) if t not in PALABRAS_VACIAS]
+
+class IndiceInvertido:
+    # BM25 sobre los campos indicados; los documentos son las posiciones en la caché.
+    # Cada término guarda sus documentos y frecuencias en arrays de NumPy; las
+    # altas se acumulan en listas y se añaden al array en la siguiente búsqueda
+    # de ese término, así puntuar miles de coincidencias es una operación
+    # vectorizada y no un bucle por documento.
+    K1 = 1.2
+    B = 0.75
+    PESO_RECIENTE = 0.2
+
+    def __init__(self, campos: dict):
+        self.campos = campos  # campo -> peso
+        self.limpiar()
+
+    def limpiar(self):
+        self.terminos = defaultdict(lambda: ([], []))  # término -> (docs, frecuencias) sin volcar
+        self.vectores = {}  # término -> (array de docs, array de frecuencias)
+        self.longitudes = []
+        self.longitud_total = 0
+        self.normas = np.zeros(0)
+        self.normas_nuevas = []
+        self.media_normas = None
+
+    def _norma(self, longitud: int) -> float:
+        return self.K1 * (1 - self.B + self.B * longitud / self.media_normas)
+
+    def _recalcular_normas(self):
+        # La normalización por longitud depende de la media; se recalcula solo
+        # cuando la media se ha desviado, no en cada alta
+        self.media_normas = (self.longitud_total / len(self.longitudes)) or 1
+        longitudes = np.asarray(self.longitudes, dtype=float)
+        self.normas = self.K1 * (1 - self.B + self.B * longitudes / self.media_normas)
+        self.normas_nuevas = []
+
+    def _vector(self, termino: str):
+        docs, frecuencias = self.terminos.get(termino, ((), ()))
+        vector = self.vectores.get(termino)
+        if docs:
+            nuevo = (np.asarray(docs, dtype=np.int64), np.asarray(frecuencias, dtype=float))
+            vector = nuevo if vector is None else (
+                np.concatenate((vector[0], nuevo[0])), np.concatenate((vector[1], nuevo[1]))
+            )
+            self.vectores[termino] = vector
+            del self.terminos[termino]
+        return vector
+
+    def agregar(self, doc: int, registro: dict):
+        frecuencias = Counter()
+        for campo, peso in self.campos.items():
+            for termino in tokenizar(registro.get(campo, "")):
+                frecuencias[termino] += peso
+        for termino, frecuencia in frecuencias.items():
+            docs, valores = self.terminos[termino]
+            docs.append(doc)
+            valores.append(frecuencia)
+        longitud = sum(frecuencias.values())
+        if doc >= len(self.longitudes):
+            self.longitudes.extend([0] * (doc + 1 - len(self.longitudes)))
+        self.longitudes[doc] = longitud
+        self.longitud_total += longitud
+        if self.media_normas is not None and len(self.normas) + len(self.normas_nuevas) == doc:
+            self.normas_nuevas.append(self._norma(longitud))
+        else:
+            self.media_normas = None
+
+    def reconstruir(self, registros: list):
+        self.limpiar()
+        for doc, registro in enumerate(registros):
+            self.agregar(doc, registro)
+
+    def buscar(self, consulta: str, limite: int = None) -> list:
+        n = len(self.longitudes)
+        if not n:
+            return []
+        media = (self.longitud_total / n) or 1
+        if self.media_normas is None or abs(media - self.media_normas) > 0.1 * self.media_normas:
+            self._recalcular_normas()
+        if self.normas_nuevas:
+            self.normas = np.concatenate((self.normas, self.normas_nuevas))
+            self.normas_nuevas = []
+        k1 = self.K1 + 1
+        puntajes = None
+        for termino in set(tokenizar(consulta)):
+            vector = self._vector(termino)
+            if vector is None:
+                continue
+            docs, frecuencias = vector
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            if puntajes is None:
+                puntajes = np.zeros(n)
+            # Un documento aparece una sola vez por término: basta una suma indexada
+            puntajes[docs] += idf * frecuencias * k1 / (frecuencias + self.normas[docs])
+        if puntajes is None:
+            return []
+        encontrados = np.flatnonzero(puntajes)
+        # A igual relevancia, primero lo más reciente (las filas nuevas van al final)
+        ajustados = puntajes[encontrados] * (1 + self.PESO_RECIENTE / n * encontrados)
+        if limite and limite < len(encontrados):
+            # Solo se ordenan los que igualan o superan al puntaje número "limite"
+            corte = len(encontrados) - limite
+            elegidos = ajustados >= np.partition(ajustados, corte)[corte]
+            encontrados, ajustados = encontrados[elegidos], ajustados[elegidos]
+        orden = np.lexsort((encontrados, -ajustados))
+        return encontrados[orden][:limite].tolist()
+
+class VectoresTfidf:
+    # Vectores TF-IDF de todos los documentos en formato disperso (CSR sin
+    # ordenar): tres arrays de NumPy con el documento, el término y la
+    # frecuencia de cada entrada. Un alta añade sus entradas al final; el idf y
+    # las normas se recalculan de una vez, vectorizados, en la siguiente
+    # consulta después de un cambio.
+    def __init__(self, campos: dict):
+        self.campos = campos  # campo -> peso
+        self.limpiar()
+
+    def limpiar(self):
+        self.vocabulario = {}  # término -> columna
+        self.df = np.zeros(256)  # documentos que contienen cada término
+        self.docs = np.zeros(1024, dtype=np.int32)
+        self.columnas = np.zeros(1024, dtype=np.int32)
+        self.frecuencias = np.zeros(1024)
+        self.entradas = 0
+        self.documentos = 0
+        self.idf = None
+        self.ponderados = None  # frecuencia * idf de cada entrada
+        self.normas = None
+
+    @staticmethod
+    def _contar(registro: dict, campos: dict) -> Counter:
+        frecuencias = Counter()
+        for campo, peso in campos.items():
+            for termino in tokenizar(registro.get(campo, "")):
+                frecuencias[termino] += peso
+        return frecuencias
+
+    @staticmethod
+    def _crecer(array, tamano: int):
+        # Capacidad doblada: añadir un documento cuesta O(1) amortizado
+        if tamano <= len(array):
+            return array
+        nuevo = np.zeros(max(tamano, 2 * len(array)), dtype=array.dtype)
+        nuevo[:len(array)] = array
+        return nuevo
+
+    def _anadir(self, docs: list, columnas: list, frecuencias: list):
+        fin = self.entradas + len(columnas)
+        self.docs = self._crecer(self.docs, fin)
+        self.columnas = self._crecer(self.columnas, fin)
+        self.frecuencias = self._crecer(self.frecuencias, fin)
+        self.docs[self.entradas:fin] = docs
+        self.columnas[self.entradas:fin] = columnas
+        self.frecuencias[self.entradas:fin] = frecuencias
+        self.df = self._crecer(self.df, len(self.vocabulario))
+        # Cada término aparece una vez por documento: sumar 1 por entrada
+        np.add.at(self.df, np.asarray(columnas, dtype=np.int32), 1)
+        self.entradas = fin
+        self.ponderados = self.normas = None
+
+    def agregar(self, doc: int, registro: dict):
+        frecuencias = self._contar(registro, self.campos)
+        columnas = [self.vocabulario.setdefault(t, len(self.vocabulario)) for t in frecuencias]
+        self._anadir([doc] * len(columnas), columnas, list(frecuencias.values()))
+        self.documentos = max(self.documentos, doc + 1)
+
+    def reconstruir(self, registros: list):
+        self.limpiar()
+        docs, columnas, frecuencias = [], [], []
+        for doc, registro in enumerate(registros):
+            for termino, frecuencia in self._contar(registro, self.campos).items():
+                docs.append(doc)
+                columnas.append(self.vocabulario.setdefault(termino, len(self.vocabulario)))
+                frecuencias.append(frecuencia)
+        self._anadir(docs, columnas, frecuencias)
+        self.documentos = len(registros)
+
+    def _preparar(self):
+        if self.normas is not None:
+            return
+        n = self.entradas
+        df = self.df[:len(self.vocabulario)]
+        idf = np.log((1 + self.documentos) / (1 + df)) + 1
+        self.ponderados = self.frecuencias[:n] * idf[self.columnas[:n]]
+        self.normas = np.sqrt(np.bincount(self.docs[:n], weights=self.ponderados ** 2, minlength=self.documentos))
+        self.normas[self.normas == 0] = 1
+        self.idf = idf
+
+    def similares(self, registro: dict, campos: dict, limite: int) -> list:
+        # Documentos ordenados por similitud coseno con el registro dado
+        if not self.entradas:
+            return []
+        consulta = {
+            self.vocabulario[termino]: frecuencia
+            for termino, frecuencia in self._contar(registro, campos).items() if termino in self.vocabulario
+        }
+        if not consulta:
+            return []
+        self._preparar()
+        vector = np.zeros(len(self.vocabulario))
+        columnas = np.fromiter(consulta.keys(), dtype=np.int32)
+        vector[columnas] = np.fromiter(consulta.values(), dtype=float) * self.idf[columnas]
+        # Producto disperso: cada entrada aporta su peso por el del mismo término
+        # en la consulta (cero si no aparece) y se suma por documento
+        n = self.entradas
+        aportes = self.ponderados * vector[self.columnas[:n]]
+        puntajes = np.bincount(self.docs[:n], weights=aportes, minlength=self.documentos) / self.normas
+        encontrados = np.flatnonzero(puntajes > 0)
+        if limite < len(encontrados):
+            # Quedarse con los que igualan o superan al puntaje número "limite",
+            # sin ordenar el resto; los empates se deciden al ordenar
+            corte = len(encontrados) - limite
+            umbral = np.partition(puntajes[encontrados], corte)[corte]
+            encontrados = encontrados[puntajes[encontrados] >= umbral]
+        # Mayor similitud primero; a igualdad, el más reciente
+        return encontrados[np.lexsort((-encontrados, -puntajes[encontrados]))][:limite].tolist()
+
+# Diario de altas
+# Las ofertas y candidatos se escriben primero en un fichero local (JSONL con
+# fsync) y se confirman al usuario en el acto. Un trabajo en segundo plano los
+# vuelca al almacenamiento por lotes, con reintentos y espera exponencial; lo
+# que quede pendiente se retoma tras un reinicio.
+class DiarioAltas:
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self.pendientes = OrderedDict()  # id de entrada -> (tabla, fila)
+        self.ultimos = {}  # tabla -> mayor ID de fila que pasó por el diario
+        self.siguiente_entrada = 1
+        self.verificar = False
+        self.espera = INTERVALO_DIARIO
+        self.proximo_intento = 0.0
+        self.escritura = None  # Future de la última escritura en el almacenamiento
+        self._hilo = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diario")
+        self._drenando = asyncio.Lock()
+        self._cargar()
+
+    def _anotar_ultimo(self, tabla: str, id_fila):
+        if str(id_fila).isdigit():
+            self.ultimos[tabla] = max(self.ultimos.get(tabla, 0), int(id_fila))
+
+    def _cargar(self):
+        if not os.path.exists(self.ruta):
+            return
+        with open(self.ruta, encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    entrada = json.loads(linea)
+                except ValueError:
+                    # Última línea a medio escribir si el proceso cayó
+                    continue
+                if "alta" in entrada:
+                    self.pendientes[entrada["alta"]] = (entrada["tabla"], entrada["fila"])
+                    self._anotar_ultimo(entrada["tabla"], entrada["fila"][0])
+                    self.siguiente_entrada = max(self.siguiente_entrada, entrada["alta"] + 1)
+                elif "ok" in entrada:
+                    self.pendientes.pop(entrada["ok"], None)
+                elif "ultimos" in entrada:
+                    for tabla, id_fila in entrada["ultimos"].items():
+                        self._anotar_ultimo(tabla, id_fila)
+        # Tras una caída puede que parte ya esté escrita: comprobar los IDs antes
+        self.verificar = bool(self.pendientes)
+        if self.pendientes:
+            logger.info(f"{len(self.pendientes)} altas pendientes recuperadas del diario")
+
+    def _escribir(self, entradas: list, truncar: bool = False):
+        with open(self.ruta, "w" if truncar else "a", encoding="utf-8") as f:
+            for entrada in entradas:
+                f.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _en_disco(self, entradas: list, truncar: bool = False):
+        # Un único hilo para el fichero: las escrituras salen en el orden pedido
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._hilo, self._escribir, entradas, truncar)
+
+    async def registrar(self, tabla: str, fila: list):
+        entrada = self.siguiente_entrada
+        self.siguiente_entrada += 1
+        # Se marca pendiente antes de escribir para que una compactación en
+        # curso nunca borre esta línea
+        self.pendientes[entrada] = (tabla, fila)
+        self._anotar_ultimo(tabla, fila[0])
+        try:
+            await self._en_disco([{"alta": entrada, "tabla": tabla, "fila": fila}])
+        except Exception:
+            self.pendientes.pop(entrada, None)
+            raise
+
+    async def _confirmar(self, entradas: list):
+        for entrada in entradas:
+            self.pendientes.pop(entrada, None)
+        if self.pendientes:
+            await self._en_disco([{"ok": entrada} for entrada in entradas])
+        else:
+            # Nada pendiente: compactar el fichero conservando los últimos IDs
+            await self._en_disco([{"ultimos": self.ultimos}], truncar=True)
+
+    def _escribir_filas(self, destino, filas: list):
+        # La escritura completa su propio Future: si llamar_almacen se rinde por
+        # timeout, el hilo sigue escribiendo y no se puede reintentar (ni
+        # verificar los IDs) hasta que termine
+        escritura = Future()
+
+        @functools.wraps(destino.agregar_filas)
+        def escribir():
+            if not escritura.set_running_or_notify_cancel():
+                return None
+            try:
+                escritura.set_result(destino.agregar_filas(filas))
+            except BaseException as e:
+                escritura.set_exception(e)
+                raise
+            return escritura.result()
+
+        return escritura, escribir
+
+    def pendientes_de(self, tabla: str) -> list:
+        return [fila for t, fila in self.pendientes.values() if t == tabla]
+
+    async def drenar(self, tablas: dict):
+        if not self.pendientes or time.monotonic() < self.proximo_intento:
+            return
+        async with self._drenando:
+            if self.escritura is not None and not self.escritura.done():
+                logger.warning("La escritura anterior del diario sigue en curso, se espera a que termine")
+                return
+            lote = list(self.pendientes.items())[:DIARIO_MAX_LOTE]
+            por_tabla = OrderedDict()
+            for entrada, (tabla, fila) in lote:
+                por_tabla.setdefault(tabla, []).append((entrada, fila))
+            completo = True
+            try:
+                for tabla, entradas in por_tabla.items():
+                    destino = tablas.get(tabla)
+                    if not destino:
+                        completo = False
+                        continue
+                    filas = [fila for _, fila in entradas]
+                    if self.verificar:
+                        existentes = set(await llamar_almacen(destino.columna, 1))
+                        filas = [fila for fila in filas if fila[0] not in existentes]
+                    if filas:
+                        self.escritura, escribir = self._escribir_filas(destino, filas)
+                        try:
+                            await llamar_almacen(escribir)
+                        except BaseException:
+                            # Si aún no empezó, ya no se hará; si empezó, se espera
+                            self.escritura.cancel()
+                            raise
+                    await self._confirmar([entrada for entrada, _ in entradas])
+                    logger.info(f"{len(filas)} altas del diario escritas en '{tabla}'")
+                self.verificar = self.verificar and not completo
+                self.espera = INTERVALO_DIARIO
+            except Exception as e:
+                # Un timeout no detiene el hilo: el lote pudo escribirse igualmente,
+                # así que el reintento espera a la escritura y comprueba antes
+                # los IDs que ya están
+                self.verificar = True
+                self.proximo_intento = time.monotonic() + self.espera
+                logger.error(f"Error volcando el diario de altas, reintento en {self.espera}s: {e}")
+                self.espera = min(self.espera * 2, DIARIO_ESPERA_MAXIMA)
+
+diario_altas = DiarioAltas(DIARIO_ALTAS)
+
+def bloquear_diario():
+    # Cerrojo exclusivo sobre el diario mientras el proceso viva: el bot lo
+    # toma al arrancar y la línea de comandos lo usa para saber si el bot está
+    # en marcha. Devuelve el fichero abierto, o None si otro proceso lo tiene.
+    f = open(f"{DIARIO_ALTAS}.lock", "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+# Detección de ofertas duplicadas
+# MinHash de una sola permutación sobre tejas de 5 caracteres: cada teja cae
+# en uno de los cubos de la firma y se queda el hash mínimo de cada cubo.
+# Las firmas se reparten por bandas (LSH), así que comprobar una oferta nueva
+# solo mira las ofertas que comparten alguna banda, no toda la hoja. Solo se
+# comparan ofertas vigentes, así que las más antiguas ni se firman.
+class DetectorDuplicados:
+    CUBOS = 32
+    FILAS_POR_BANDA = 4
+    TEJA = 5
+    MAX_TEXTO = 1000
+    MAX_CANDIDATOS = 20  # Por banda, empezando por las más recientes
+
+    def __init__(self, campos: list, umbral: float = UMBRAL_DUPLICADO, campo_fecha: str = "Fecha",
+                 dias: int = DIAS_VIGENCIA_OFERTAS):
+        self.campos = campos
+        self.umbral = umbral
+        self.campo_fecha = campo_fecha
+        self.dias = dias
+        self.reconstruir([])
+
+    def _desde(self) -> str:
+        return (datetime.now() - timedelta(days=self.dias)).strftime("%Y-%m-%d")
+
+    def firma(self, registro: dict):
+        texto = " ".join(tokenizar(" ".join(str(registro.get(c, "")) for c in self.campos)))[:self.MAX_TEXTO]
+        if not texto:
+            return None
+        firma = [None] * self.CUBOS
+        for i in range(max(1, len(texto) - self.TEJA + 1)):
+            h = hash(texto[i:i + self.TEJA]) & 0xFFFFFFFFFFFFFFFF
+            cubo, valor = h % self.CUBOS, h // self.CUBOS
+            if firma[cubo] is None or valor < firma[cubo]:
+                firma[cubo] = valor
+        return firma
+
+    def _bandas(self, firma: list):
+        for b in range(0, self.CUBOS, self.FILAS_POR_BANDA):
+            banda = tuple(firma[b:b + self.FILAS_POR_BANDA])
+            # Las bandas vacías (textos muy cortos) coincidirían con todo
+            if any(v is not None for v in banda):
+                yield (b, banda)
+
+    @staticmethod
+    def similitud(a: list, b: list) -> float:
+        usados = iguales = 0
+        for x, y in zip(a, b):
+            if x is None and y is None:
+                continue
+            usados += 1
+            iguales += x == y
+        return iguales / usados if usados else 0.0
+
+    def agregar(self, doc: int, registro: dict, desde: str = None):
+        fecha = registro.get(self.campo_fecha, "")
+        if fecha < (desde or self._desde()):
+            return
+        firma = self.firma(registro)
+        self.firmas[doc] = firma
+        self.fechas[doc] = fecha
+        if firma:
+            for clave in self._bandas(firma):
+                self.cubetas[clave].append(doc)
+
+    def reconstruir(self, registros: list):
+        self.firmas = {}
+        self.fechas = {}
+        self.cubetas = defaultdict(list)
+        desde = self._desde()
+        for doc, registro in enumerate(registros):
+            self.agregar(doc, registro, desde)
+
+    def parecido(self, registro: dict):
+        # Devuelve (doc, similitud) de la oferta vigente más parecida por
+        # encima del umbral, o None
+        firma = self.firma(registro)
+        if not firma:
+            return None
+        desde = self._desde()
+        mejor = None
+        vistos = set()
+        for clave in self._bandas(firma):
+            for doc in reversed(self.cubetas.get(clave, [])[-self.MAX_CANDIDATOS:]):
+                if doc in vistos or self.fechas.get(doc, "") < desde:
+                    continue
+                vistos.add(doc)
+                similitud = self.similitud(firma, self.firmas[doc])
+                if similitud >= self.umbral and (mejor is None or similitud > mejor[1]):
+                    mejor = (doc, similitud)
+        return mejor
+
+# Filtro de abuso
+# Un solo patrón compilado para todas las palabras prohibidas. Las palabras
+# solo cuentan completas ("antifraude" no es "fraude"); los prefijos como
+# "http://" se buscan en cualquier parte del texto
+def _patron_prohibido(palabra: str) -> str:
+    palabra = normalizar(palabra)
+    return rf"\b{re.escape(palabra)}\b" if re.fullmatch(r"\w+", palabra) else re.escape(palabra)
+
+PATRON_PROHIBIDO = re.compile("|".join(
+    _patron_prohibido(palabra) for palabra in sorted(PALABRAS_PROHIBIDAS, key=len, reverse=True)
+))
+
+def texto_prohibido(texto: str) -> bool:
+    return bool(PATRON_PROHIBIDO.search(normalizar(texto)))
+
+class LimitadorUsuarios:
+    # Cubeta de tokens por usuario; se guardan como mucho max_usuarios y se
+    # descartan los que llevan más tiempo sin escribir (su cubeta ya estaría llena)
+    def __init__(self, cubetas: OrderedDict, tasa: float, rafaga: int, max_usuarios: int):
+        self.cubetas = cubetas
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.max_usuarios = max_usuarios
+
+    def permitir(self, user_id: int):
+        # Devuelve True si se permite, False si se rechaza y None si se rechaza
+        # y ya se avisó al usuario
+        ahora = time.monotonic()
+        cubeta = self.cubetas.get(user_id)
+        if cubeta is None:
+            cubeta = [float(self.rafaga), ahora, False]
+            self.cubetas[user_id] = cubeta
+            if len(self.cubetas) > self.max_usuarios:
+                self.cubetas.popitem(last=False)
+        else:
+            self.cubetas.move_to_end(user_id)
+            cubeta[0] = min(self.rafaga, cubeta[0] + (ahora - cubeta[1]) * self.tasa)
+            cubeta[1] = ahora
+        if cubeta[0] >= 1:
+            cubeta[0] -= 1
+            cubeta[2] = False
+            return True
+        if cubeta[2]:
+            return None
+        cubeta[2] = True
+        return False
+
+limitador_usuarios = LimitadorUsuarios(
+    ULTIMOS_MENSAJES, LIMITE_MENSAJES_USUARIO, RAFAGA_MENSAJES_USUARIO, MAX_USUARIOS_LIMITADOS
+)
+
+async def filtro_abuso(update: Update, context: CallbackContext):
+    # Se ejecuta antes que los demás manejadores: lo rechazado aquí no llega a
+    # tocar el almacenamiento
+    usuario = update.effective_user
+    if not usuario or usuario.id in ADMIN_IDS:
+        return
+    if update.inline_query:
+        # Llega una por tecla pulsada; se resuelven en memoria y con espera
+        return
+    permitido = limitador_usuarios.permitir(usuario.id)
+    if not permitido:
+        if permitido is False:
+            logger.warning(f"Usuario {usuario.id} limitado por exceso de mensajes")
+            if update.callback_query:
+                await update.callback_query.answer("⏳ Demasiadas solicitudes, espera un momento.")
+            elif update.effective_message:
+                await update.effective_message.reply_text("⏳ Demasiadas solicitudes, espera un momento.")
+        raise ApplicationHandlerStop
+    mensaje = update.message
+    if mensaje and mensaje.text and not mensaje.text.startswith("/") and texto_prohibido(mensaje.text):
+        # Los textos sueltos son los pasos de las conversaciones: se pide otro
+        # texto y la conversación sigue en el mismo paso
+        await mensaje.reply_text("⚠️ Tu mensaje contiene palabras o enlaces no permitidos. Escríbelo de nuevo.")
+        raise ApplicationHandlerStop
+
+# Estadísticas
+# Agregados que se mantienen con cada alta, con los mismos ganchos que el
+# índice de búsqueda: /stats los consulta sin leer ninguna hoja.
+class AgregadosAltas:
+    def __init__(self, campo_categoria: str, campo_fecha: str = "Fecha"):
+        self.campo_categoria = campo_categoria
+        self.campo_fecha = campo_fecha
+        self.reconstruir([])
+
+    def agregar(self, doc: int, registro: dict):
+        self.por_dia[str(registro.get(self.campo_fecha, ""))[:10]] += 1
+        self.categorias.update({t for t in tokenizar(registro.get(self.campo_categoria, "")) if not t.isdigit()})
+
+    def reconstruir(self, registros: list):
+        self.por_dia = Counter()
+        self.categorias = Counter()
+        for registro in registros:
+            self.agregar(None, registro)
+
+    def en_dias(self, desde: int, hasta: int = 0) -> int:
+        # Altas entre hace `desde` días (incluido) y hace `hasta` días (excluido)
+        hoy = datetime.now()
+        return sum(
+            self.por_dia[(hoy - timedelta(days=d)).strftime("%Y-%m-%d")]
+            for d in range(hasta, desde)
+        )
+
+# Palabras de /buscar y /buscarcandidatos desde el arranque
+terminos_buscados = Counter()
+MAX_TERMINOS_BUSCADOS = 10000
+
+def anotar_busqueda(consulta: str):
+    terminos_buscados.update(tokenizar(consulta))
+    if len(terminos_buscados) > MAX_TERMINOS_BUSCADOS:
+        # Quedarse con la mitad más buscada
+        conservar = terminos_buscados.most_common(MAX_TERMINOS_BUSCADOS // 2)
+        terminos_buscados.clear()
+        terminos_buscados.update(dict(conservar))
+
+# Caché en memoria de las hojas
+# Al recargar, los registros y los ganchos nuevos se construyen en un hilo
+# aparte y se cambian de una vez: mientras tanto se sigue sirviendo la caché
+# anterior y el event loop no se detiene aunque la hoja tenga 100k filas.
+_versiones = itertools.count(int(time.time()))
+executor_caches = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caches")
+
+class CacheHoja:
+    GANCHOS = ("indice", "duplicados", "agregados", "vectores")
+
+    def __init__(self, hoja, ttl: int = CACHE_TTL, indice: IndiceInvertido = None,
+                 duplicados: DetectorDuplicados = None, agregados: AgregadosAltas = None,
+                 vectores: VectoresTfidf = None):
+        self.hoja = hoja
+        self.ttl = ttl
+        # Estructuras que se reconstruyen al recargar y se actualizan con cada alta
+        self.indice = indice
+        self.duplicados = duplicados
+        self.agregados = agregados
+        self.vectores = vectores
+        self.encabezados = []
+        self.registros = []
+        self.cargado_en = None
+        self.version = None
+        self._lock = asyncio.Lock()
+        self._refresco = None
+        self._altas_en_recarga = None
+
+    def _nueva_version(self):
+        # Cambia con cada recarga o alta; parte de la hora de arranque para que
+        # no se repita entre reinicios
+        self.version = next(_versiones)
+
+    def _ganchos(self):
+        return [g for g in (getattr(self, nombre) for nombre in self.GANCHOS) if g]
+
+    def vigente(self):
+        return self.cargado_en is not None and time.monotonic() - self.cargado_en < self.ttl
+
+    def _construir(self, encabezados: list, filas: list, anteriores: list):
+        # En el hilo de las cachés, sin tocar nada que use el event loop.
+        # Devuelve None si los datos son los mismos que ya hay en memoria
+        registros = [dict(zip(encabezados, fila)) for fila in filas]
+        if encabezados == self.encabezados and registros == anteriores:
+            return None
+        ganchos = {}
+        for nombre in self.GANCHOS:
+            gancho = getattr(self, nombre)
+            if gancho:
+                # reconstruir() sustituye todas las estructuras de la copia,
+                # así que la original no se modifica
+                gancho = copy.copy(gancho)
+                gancho.reconstruir(registros)
+            ganchos[nombre] = gancho
+        return registros, ganchos
+
+    async def recargar(self):
+        # Si ya hay una recarga en curso, esperar a esa en vez de lanzar otra
+        async with self._lock:
+            if self.vigente():
+                return
+            # Una sola lectura de la hoja; la primera fila son los encabezados
+            valores = await llamar_almacen(self.hoja.leer_todo)
+            encabezados = valores[0] if valores else []
+            # Añadir las altas del diario que aún no llegaron a la hoja
+            ids = {fila[0] for fila in valores[1:] if fila}
+            filas = valores[1:] + [f for f in diario_altas.pendientes_de(self.hoja.titulo) if f[0] not in ids]
+            # Las altas que lleguen mientras se construye van a la caché actual
+            # y se repiten sobre la nueva si la lectura no las incluía
+            self._altas_en_recarga = []
+            try:
+                loop = asyncio.get_running_loop()
+                construido = await loop.run_in_executor(
+                    executor_caches, self._construir, encabezados, filas, list(self.registros)
+                )
+            finally:
+                altas, self._altas_en_recarga = self._altas_en_recarga, None
+            self.cargado_en = time.monotonic()
+            if construido is None:
+                logger.info(f"Caché de '{self.hoja.titulo}' sin cambios: {len(self.registros)} filas")
+                return
+            self.encabezados = encabezados
+            self.registros, ganchos = construido
+            for nombre, gancho in ganchos.items():
+                setattr(self, nombre, gancho)
+            self._nueva_version()
+            ids.update(fila[0] for fila in filas if fila)
+            for fila in altas:
+                if fila[0] not in ids:
+                    self.agregar(fila)
+            logger.info(f"Caché de '{self.hoja.titulo}' recargada: {len(self.registros)} filas")
+
+    async def _recargar_en_segundo_plano(self):
+        try:
+            await self.recargar()
+        except Exception as e:
+            logger.error(f"Error recargando caché de '{self.hoja.titulo}': {e}")
+        finally:
+            self._refresco = None
+
+    async def obtener(self):
+        if self.cargado_en is None:
+            metricas.contar("empleo_cache_total", cache=self.hoja.titulo, resultado="fallo")
+            await self.recargar()
+        elif not self.vigente():
+            metricas.contar("empleo_cache_total", cache=self.hoja.titulo, resultado="caducada")
+            if self._refresco is None:
+                # Servir los datos actuales y refrescar sin hacer esperar al usuario
+                self._refresco = asyncio.create_task(self._recargar_en_segundo_plano())
+        else:
+            metricas.contar("empleo_cache_total", cache=self.hoja.titulo, resultado="acierto")
+        return self.registros
+
+    def agregar(self, fila: list):
+        # Mantener la caché al día tras un alta sin releer la hoja
+        if self._altas_en_recarga is not None:
+            self._altas_en_recarga.append(fila)
+        if self.cargado_en is None or not self.encabezados:
+            return
+        registro = dict(zip(self.encabezados, fila))
+        self.registros.append(registro)
+        for gancho in self._ganchos():
+            gancho.agregar(len(self.registros) - 1, registro)
+        self._nueva_version()
+
+    def invalidar(self):
+        self.cargado_en = None
+
+cache_ofertas = CacheHoja(
+    ofertas_db, indice=IndiceInvertido({"Puesto": 2, "Empresa": 1, "Descripcion": 1}),
+    duplicados=DetectorDuplicados(["Puesto", "Empresa", "Descripcion"]),
+    agregados=AgregadosAltas("Puesto")
+) if ofertas_db else None
+cache_candidatos = CacheHoja(
+    candidatos_db, indice=IndiceInvertido({"Trabajo": 2, "Escolaridad": 1}),
+    agregados=AgregadosAltas("Trabajo"), vectores=VectoresTfidf({"Trabajo": 2, "Escolaridad": 1})
+) if candidatos_db else None
+
+# Asignación de IDs
+# Cada ID es el milisegundo del alta, un número de secuencia de tres cifras
+# dentro de ese milisegundo y el número de réplica de dos cifras. No hace
+# falta leer la hoja ni sembrar nada desde Sheets, dos altas del mismo
+# proceso nunca coinciden y dos réplicas del modo webhook tampoco, aunque
+# estén en máquinas distintas. Los IDs antiguos (1, 2, 3...) quedan siempre
+# por debajo.
+class AsignadorIds:
+    SECUENCIAS = 1000
+    REPLICAS = 100
+
+    def __init__(self, hoja, replica: int = REPLICA):
+        self.hoja = hoja
+        self.replica = replica
+        # Si el reloj retrocede tras un reinicio, seguir desde el último ID
+        # que pasó por el diario en vez de repetirlo
+        ultimo = diario_altas.ultimos.get(hoja.titulo, 0) // self.REPLICAS
+        self.instante, self.secuencia = divmod(ultimo, self.SECUENCIAS)
+
+    def siguiente(self) -> str:
+        ahora = int(time.time() * 1000)
+        if ahora > self.instante:
+            self.instante, self.secuencia = ahora, 0
+        else:
+            self.secuencia += 1
+            if self.secuencia == self.SECUENCIAS:
+                # Más de mil altas en un milisegundo: tomar el siguiente
+                self.instante, self.secuencia = self.instante + 1, 0
+        return str((self.instante * self.SECUENCIAS + self.secuencia) * self.REPLICAS + self.replica)
+
+ids_ofertas = AsignadorIds(ofertas_db) if ofertas_db else None
+ids_candidatos = AsignadorIds(candidatos_db) if candidatos_db else None
 
 # Funciones de base de datos
-def registrar_usuario(user_id: int, nombre: str, username: str, chat_id: int):
-    if not usuarios_db:
+# Registro de usuarios
+# Índice user_id -> fila cargado una vez; las fechas de última visita y los
+# usuarios nuevos se acumulan en memoria y se escriben cada
+# INTERVALO_VOLCADO_USUARIOS segundos con dos escrituras por lotes.
+class RegistroUsuarios:
+    def __init__(self, hoja):
+        self.hoja = hoja
+        self.filas = {}
+        self.inactivos = set()  # Filas con Estado "inactivo"
+        self.fechas = {}
+        self.nuevos = {}
+        self.en_vuelo = set()
+        self.cargado = False
+        self._lock = asyncio.Lock()
+
+    async def cargar(self):
+        async with self._lock:
+            if self.cargado:
+                return
+            ids, estados = await asyncio.gather(
+                llamar_almacen(self.hoja.columna, 1),
+                llamar_almacen(self.hoja.columna, 7)
+            )
+            self.filas = {}
+            for fila, uid in enumerate(ids[1:], start=2):
+                if uid:
+                    self.filas.setdefault(uid, fila)
+            self.inactivos = {fila for fila, estado in enumerate(estados[1:], start=2) if estado == "inactivo"}
+            self.cargado = True
+            logger.info(f"Índice de usuarios cargado: {len(self.filas)} usuarios")
+
+    async def registrar(self, user_id: int, nombre: str, username: str, chat_id: int):
+        if not self.cargado:
+            await self.cargar()
+        uid = str(user_id)
+        ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if uid in self.filas:
+            self.fechas[self.filas[uid]] = ahora
+        elif uid in self.nuevos:
+            self.nuevos[uid][4] = ahora
+        elif uid not in self.en_vuelo:
+            self.nuevos[uid] = [
+                uid,
+                nombre,
+                f"@{username}" if username else "Sin username",
+                str(chat_id),
+                ahora,
+                "0",
+                "activo"
+            ]
+
+    async def volcar(self):
+        async with self._lock:
+            if self.fechas:
+                fechas, self.fechas = self.fechas, {}
+                # Quien vuelve a usar /start no tiene al bot bloqueado
+                celdas = []
+                for fila, fecha in fechas.items():
+                    celdas.append((fila, 5, fecha))
+                    celdas.append((fila, 7, "activo"))
+                try:
+                    await llamar_almacen(self.hoja.actualizar_celdas, celdas)
+                except Exception:
+                    for fila, fecha in fechas.items():
+                        self.fechas.setdefault(fila, fecha)
+                    raise
+                self.inactivos.difference_update(fechas)
+                logger.info(f"Fechas actualizadas para {len(fechas)} usuarios")
+            if self.nuevos:
+                nuevos, self.nuevos = self.nuevos, {}
+                self.en_vuelo.update(nuevos)
+                try:
+                    primera = await llamar_almacen(self.hoja.agregar_filas, list(nuevos.values()))
+                except Exception:
+                    for uid, fila in nuevos.items():
+                        self.nuevos.setdefault(uid, fila)
+                    raise
+                finally:
+                    self.en_vuelo.difference_update(nuevos)
+                if primera:
+                    for fila, uid in enumerate(nuevos, start=primera):
+                        self.filas[uid] = fila
+                else:
+                    # Sin el rango escrito no sabemos las filas: recargar el índice
+                    self.cargado = False
+                logger.info(f"{len(nuevos)} usuarios nuevos registrados")
+
+registro_usuarios = RegistroUsuarios(usuarios_db) if usuarios_db else None
+
+async def registrar_usuario(user_id: int, nombre: str, username: str, chat_id: int):
+    if not registro_usuarios:
         logger.error("No se pudo acceder a usuarios_db")
         return False
     try:
-        # Buscar si el usuario ya existe
-        cell = usuarios_db.find(str(user_id), in_column=1)
-        # Usuario existe, actualizar la fecha
-        row = cell.row
-        usuarios_db.update_cell(row, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        logger.info(f"Fecha actualizada para usuario {user_id}")
-        return True
-    except gspread.exceptions.CellNotFound:
-        # Usuario no existe, crear nueva fila
-        usuarios_db.append_row([
-            str(user_id),
-            nombre,
-            f"@{username}" if username else "Sin username",
-            str(chat_id),
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "0",
-            "activo"
-        ])
-        logger.info(f"Nuevo usuario registrado: {user_id}")
+        await registro_usuarios.registrar(user_id, nombre, username, chat_id)
         return True
     except Exception as e:
         logger.error(f"Error registrando usuario {user_id}: {e}")
         return False
 
-def nueva_oferta(user_id: int, datos: dict):
+async def volcar_usuarios(context: CallbackContext):
+    try:
+        await registro_usuarios.volcar()
+    except Exception as e:
+        logger.error(f"Error volcando usuarios a Sheets: {e}")
+
+async def nueva_oferta(user_id: int, datos: dict):
     if not ofertas_db:
         return False
     try:
-        ofertas_db.append_row([
-            str(len(ofertas_db.col_values(1)) + 1),
+        fila = [
+            ids_ofertas.siguiente(),
             datos["puesto"],
             datos["empresa"],
             datos["salario"],
@@ -101,35 +1569,241 @@ def nueva_oferta(user_id: int, datos: dict):
             datos["contacto"],
             datetime.now().strftime("%Y-%m-%d"),
             str(user_id)
-        ])
-        return True
+        ]
+        await diario_altas.registrar(ofertas_db.titulo, fila)
+        cache_ofertas.agregar(fila)
+        return fila
     except Exception as e:
         logger.error(f"Error guardando oferta: {e}")
         return False
 
-def nuevo_candidato(user_id: int, datos: dict):
+async def oferta_repetida(datos: dict):
+    # Devuelve la oferta vigente casi igual a la nueva, si la hay
+    if not cache_ofertas:
+        return None
+    try:
+        registros = await cache_ofertas.obtener()
+    except Exception as e:
+        logger.error(f"No se pudo comprobar si la oferta está repetida: {e}")
+        return None
+    parecida = cache_ofertas.duplicados.parecido({
+        "Puesto": datos["puesto"], "Empresa": datos["empresa"], "Descripcion": datos["descripcion"]
+    })
+    if not parecida:
+        return None
+    doc, similitud = parecida
+    logger.info(f"Oferta repetida rechazada: similitud {similitud:.2f} con la oferta {registros[doc].get('ID')}")
+    return registros[doc]
+
+async def nuevo_candidato(user_id: int, datos: dict):
     if not candidatos_db:
         return False
     try:
-        candidatos_db.append_row([
-            str(len(candidatos_db.col_values(1)) + 1),
+        fila = [
+            ids_candidatos.siguiente(),
             datos["nombre"],
             datos["trabajo"],
             datos["escolaridad"],
             datos["contacto"],
             datetime.now().strftime("%Y-%m-%d"),
             str(user_id)
-        ])
-        return True
+        ]
+        await diario_altas.registrar(candidatos_db.titulo, fila)
+        cache_candidatos.agregar(fila)
+        return fila
     except Exception as e:
         logger.error(f"Error guardando candidato: {e}")
         return False
 
+async def drenar_diario(context: CallbackContext):
+    await diario_altas.drenar({tabla.titulo: tabla for tabla in (ofertas_db, candidatos_db) if tabla})
+
+async def replicar_a_sheets(context: CallbackContext):
+    try:
+        replicados = 0
+        while lote := await llamar_almacen(almacen.replicar):
+            replicados += lote
+        if replicados:
+            logger.info(f"{replicados} cambios replicados a Sheets")
+    except Exception as e:
+        # Los cambios siguen en la cola y se reintentan en la próxima pasada
+        logger.error(f"Error replicando a Sheets: {e}")
+
+# Importación y exportación
+# Los ficheros se recorren fila a fila: se importan en lotes de
+# LOTE_IMPORTACION filas (una llamada append_rows por lote) y se exportan
+# leyendo páginas de PAGINA_EXPORTACION filas, así la memoria no crece con
+# el tamaño del fichero.
+FORMATOS = ("csv", "jsonl")
+
+def tablas_transferibles() -> dict:
+    # nombre -> (tabla, asignador de IDs, caché)
+    return {
+        nombre: (tabla, ids, cache)
+        for nombre, tabla, ids, cache in (
+            ("ofertas", ofertas_db, ids_ofertas, cache_ofertas),
+            ("candidatos", candidatos_db, ids_candidatos, cache_candidatos),
+        )
+        if tabla
+    }
+
+def formato_de(nombre: str):
+    extension = os.path.splitext(nombre or "")[1].lower().lstrip(".")
+    return {"json": "jsonl", "ndjson": "jsonl"}.get(extension, extension) if extension else None
+
+def leer_registros(f, formato: str):
+    # Devuelve (línea, registro); registro es None si la línea no se entiende
+    if formato == "csv":
+        lector = csv.DictReader(f)
+        for registro in lector:
+            yield lector.line_num, registro
+        return
+    for numero, linea in enumerate(f, start=1):
+        if not linea.strip():
+            continue
+        try:
+            yield numero, json.loads(linea)
+        except json.JSONDecodeError:
+            yield numero, None
+
+def validar_registro(registro, encabezados: list, user_id: int):
+    # Devuelve (fila sin ID, error). Las columnas se buscan sin distinguir
+    # mayúsculas; el ID siempre se asigna de nuevo para no chocar con los existentes
+    if not isinstance(registro, dict):
+        return None, "formato no válido"
+    valores = {
+        str(campo).strip().lower(): str(valor).strip()
+        for campo, valor in registro.items() if campo is not None and valor is not None
+    }
+    fila = []
+    for campo in encabezados[1:]:
+        valor = valores.get(campo.lower(), "")
+        if campo == "Fecha":
+            try:
+                valor = datetime.strptime(valor, "%Y-%m-%d").strftime("%Y-%m-%d")
+            except ValueError:
+                valor = datetime.now().strftime("%Y-%m-%d")
+        elif campo == "UserID":
+            valor = valor if valor.isdigit() else str(user_id)
+        elif not valor:
+            return None, f"falta {campo}"
+        elif texto_prohibido(valor):
+            return None, f"{campo} con palabras o enlaces no permitidos"
+        fila.append(valor)
+    return fila, None
+
+async def importar_registros(f, formato: str, nombre: str, user_id: int = 0) -> dict:
+    tabla, ids, cache = tablas_transferibles()[nombre]
+    encabezados = ENCABEZADOS[tabla.titulo]
+    resumen = {"importadas": 0, "rechazadas": 0, "errores": [], "fallo": None}
+    lote = []
+    
+    async def escribir(filas: list):
+        await llamar_almacen(tabla.agregar_filas, filas)
+        if cache:
+            for fila in filas:
+                cache.agregar(fila)
+        resumen["importadas"] += len(filas)
+    
+    try:
+        for numero, registro in leer_registros(f, formato):
+            fila, error = validar_registro(registro, encabezados, user_id)
+            if error:
+                resumen["rechazadas"] += 1
+                if len(resumen["errores"]) < MAX_ERRORES_IMPORTACION:
+                    resumen["errores"].append(f"línea {numero}: {error}")
+                continue
+            lote.append([ids.siguiente()] + fila)
+            if len(lote) >= LOTE_IMPORTACION:
+                filas, lote = lote, []
+                await escribir(filas)
+        if lote:
+            await escribir(lote)
+    except Exception as e:
+        # Lo ya escrito se queda; el resumen dice hasta dónde se llegó
+        logger.error(f"Error importando {nombre}: {e}")
+        resumen["fallo"] = str(e)
+    logger.info(f"Importación de {nombre}: {resumen['importadas']} filas, {resumen['rechazadas']} rechazadas")
+    return resumen
+
+async def exportar_registros(f, formato: str, nombre: str) -> int:
+    tabla = tablas_transferibles()[nombre][0]
+    encabezados = ENCABEZADOS[tabla.titulo]
+    escritor = csv.writer(f) if formato == "csv" else None
+    if escritor:
+        escritor.writerow(encabezados)
+    total = 0
+    inicio = 2
+    while True:
+        filas = await llamar_almacen(tabla.leer_rangos, [(inicio, inicio + PAGINA_EXPORTACION - 1)])
+        for fila in filas:
+            if not any(fila):
+                continue
+            fila = (list(fila) + [""] * len(encabezados))[:len(encabezados)]
+            if escritor:
+                escritor.writerow(fila)
+            else:
+                f.write(json.dumps(dict(zip(encabezados, fila)), ensure_ascii=False) + "\n")
+            total += 1
+        # Sheets omite las filas vacías del final: una página incompleta es la última
+        if len(filas) < PAGINA_EXPORTACION:
+            return total
+        inicio += PAGINA_EXPORTACION
+
+# Caducidad de ofertas
+def agrupar_filas(filas: list) -> list:
+    # [2, 3, 4, 9, 10] -> [(2, 4), (9, 10)]
+    rangos = []
+    for fila in sorted(filas):
+        if rangos and fila == rangos[-1][1] + 1:
+            rangos[-1] = (rangos[-1][0], fila)
+        else:
+            rangos.append((fila, fila))
+    return rangos
+
+async def archivar_ofertas(filas: list):
+    try:
+        archivo = await llamar_almacen(almacen.tabla, HOJA_ARCHIVO, crear=True)
+        await llamar_almacen(archivo.agregar_filas, filas)
+    except Exception as e:
+        # Sin hoja de archivo, no perder las ofertas: guardarlas en disco
+        logger.error(f"Error archivando en la tabla {HOJA_ARCHIVO}, se usará {ARCHIVO_LOCAL_OFERTAS}: {e}")
+        with open(ARCHIVO_LOCAL_OFERTAS, "a", encoding="utf-8") as f:
+            for fila in filas:
+                f.write(json.dumps(fila, ensure_ascii=False) + "\n")
+
+async def caducar_ofertas(context: CallbackContext):
+    if not ofertas_db:
+        return
+    try:
+        # Solo la columna Fecha (7); la fila 1 son los encabezados
+        fechas = await llamar_almacen(ofertas_db.columna, 7)
+        limite = datetime.now() - timedelta(days=DIAS_VIGENCIA_OFERTAS)
+        vencidas = []
+        for fila, fecha in enumerate(fechas[1:], start=2):
+            try:
+                if datetime.strptime(fecha.strip(), "%Y-%m-%d") < limite:
+                    vencidas.append(fila)
+            except ValueError:
+                continue
+        if not vencidas:
+            return
+        rangos = agrupar_filas(vencidas)
+        # Una lectura para todos los rangos, una escritura al archivo y un
+        # único borrado por lotes
+        await archivar_ofertas(await llamar_almacen(ofertas_db.leer_rangos, rangos))
+        await llamar_almacen(ofertas_db.borrar_rangos, rangos)
+        # Las posiciones cambiaron: la próxima lectura recarga la hoja
+        cache_ofertas.invalidar()
+        logger.info(f"{len(vencidas)} ofertas caducadas archivadas y eliminadas en {len(rangos)} rangos")
+    except Exception as e:
+        logger.error(f"Error caducando ofertas: {e}")
+
 # Comandos básicos
 async def start(update: Update, context: CallbackContext):
     user = update.effective_user
     chat_id = update.effective_chat.id
-    if registrar_usuario(user.id, user.first_name, user.username, chat_id):
+    if await registrar_usuario(user.id, user.first_name, user.username, chat_id):
         logger.info(f"Usuario {user.id} registrado o actualizado correctamente")
     else:
         logger.error(f"Fallo al registrar usuario {user.id}")
@@ -159,212 +1833,334 @@ async def ayuda(update: Update, context: CallbackContext):
         "📎 /start \\— Iniciar el bot\n"
         "📋 /menu \\— Ver el menú interactivo\n"
         "💼 /ofertar \\— Publicar una oferta de empleo\n"
-        "🔍 /buscar \\— Buscar ofertas publicadas\n"
+        "🔍 /buscar \\— Buscar ofertas publicadas \\(o por palabras: /buscar cocinero\\)\n"
+        "🔎 /buscarcandidatos \\— Buscar trabajadores \\(o por palabras: /buscarcandidatos chofer\\)\n"
         "🧑‍💼 /buscoempleo \\— Registrarte como buscador de empleo\n"
+        "🔔 /alerta \\— Recibir avisos de nuevas ofertas \\(p\\. ej\\. /alerta cocinero\\)\n"
+        "👥 /misofertas \\— Ver tus ofertas y los candidatos que mejor encajan\n"
         "❌ /cancelar \\— Cancelar una acción activa\n\n"
         "👩‍💻 Este Bot está en fase Beta, si encuentras algún problema o tienes sugerencias puedes contactar con Soporte @AtencionPoblacionBot\n\n"
         "*⚠️ ATENCIÓN\\!\\!\\!* Las ofertas se irán eliminando automáticamente cada 15 días, tenga eso en cuenta",
         parse_mode="MarkdownV2"
     )
 
-# Búsquedas
-async def buscar_ofertas(update: Update, context: CallbackContext):
-    context.user_data['pagina_ofertas'] = 0  # Inicializar en 0 para la primera página
-    logger.info("Iniciando búsqueda de ofertas")
-    if not ofertas_db:
-        await update.message.reply_text("Error al acceder a ofertas")
+# Búsquedas y paginación
+# La posición y la versión de los datos viajan en el callback_data
+# ("pag:<tipo>:<versión>:<inicio>:<consulta>"), así que no se guarda nada en
+# user_data: la paginación sobrevive a reinicios y a varios mensajes abiertos.
+# Cada página se renderiza una sola vez por versión de los datos.
+def formatear_oferta(oferta: dict) -> str:
+    return (
+        f"💼 {oferta['Puesto']}\n"
+        f"🏢 {oferta['Empresa']}\n"
+        f"💰 {oferta['Salario']}\n"
+        f"📞 {oferta['Contacto']}\n\n"
+    )
+
+def formatear_candidato(candidato: dict) -> str:
+    return (
+        f"👤 {candidato['Nombre']}\n"
+        f"🛠️ {candidato['Trabajo']}\n"
+        f"📞 {candidato['Contacto']}\n\n"
+    )
+
+class Paginador:
+    def __init__(self, tipo: str, nombre: str, formatear, cache: CacheHoja, max_paginas: int = PAGINAS_EN_CACHE):
+        self.tipo = tipo
+        self.nombre = nombre
+        self.formatear = formatear
+        self.cache = cache
+        self.max_paginas = max_paginas
+        self.paginas = OrderedDict()
+        self.resultados = OrderedDict()
+
+    def _guardar(self, lru: OrderedDict, clave, valor):
+        lru[clave] = valor
+        if len(lru) > self.max_paginas:
+            lru.popitem(last=False)
+
+    def consulta_compacta(self, consulta: str, version: int) -> str:
+        # callback_data admite 64 bytes: se guardan las palabras ya normalizadas
+        # (ASCII) y se descartan las últimas si no caben
+        libre = 64 - len(f"pag:{self.tipo}:{version:x}:{10 ** 6}:")
+        compacta = ""
+        for termino in tokenizar(consulta):
+            if len(compacta) + len(termino) + 1 > libre:
+                break
+            compacta = f"{compacta} {termino}" if compacta else termino
+        return compacta
+
+    def buscar(self, consulta: str, hasta: int = RESULTADOS_ORDENADOS) -> list:
+        # Devuelve al menos las "hasta" primeras posiciones, si las hay. Solo se
+        # ordenan las necesarias; si luego se pide una página más allá, la
+        # búsqueda se repite con un límite al menos el doble de grande
+        cache = self.cache
+        if not consulta:
+            return range(len(cache.registros))
+        clave = (cache.version, consulta)
+        guardado = self.resultados.get(clave)  # (posiciones, completas)
+        if guardado and (guardado[1] or len(guardado[0]) >= hasta):
+            self.resultados.move_to_end(clave)
+            return guardado[0]
+        limite = max(hasta, RESULTADOS_ORDENADOS, 2 * len(guardado[0]) if guardado else 0)
+        posiciones = cache.indice.buscar(consulta, limite)
+        self._guardar(self.resultados, clave, (posiciones, len(posiciones) < limite))
+        return posiciones
+
+    def pagina(self, consulta: str, inicio: int):
+        cache = self.cache
+        clave = (cache.version, consulta, inicio)
+        if clave in self.paginas:
+            metricas.contar("empleo_cache_total", cache=f"paginas_{self.nombre}", resultado="acierto")
+            self.paginas.move_to_end(clave)
+            return self.paginas[clave]
+        metricas.contar("empleo_cache_total", cache=f"paginas_{self.nombre}", resultado="fallo")
+        fin = inicio + RESULTADOS_POR_PAGINA
+        # Uno más de los que caben para saber si hay otra página
+        posiciones = self.buscar(consulta, fin + 1)
+        seleccion = [cache.registros[i] for i in posiciones[inicio:fin]]
+        if not seleccion:
+            if not cache.registros:
+                texto = f"No hay {self.nombre} disponibles"
+            elif consulta and not posiciones:
+                texto = f"No se encontraron {self.nombre} para: {consulta}"
+            else:
+                texto = f"No hay más {self.nombre} para mostrar"
+            renderizada = (texto, None)
+        else:
+            # Los resultados de una búsqueda ya vienen ordenados por relevancia
+            texto = "".join(self.formatear(r) for r in (seleccion if consulta else reversed(seleccion)))
+            botones = []
+            if inicio > 0:
+                anterior = max(0, inicio - RESULTADOS_POR_PAGINA)
+                botones.append(InlineKeyboardButton(
+                    "⬅️ Atrás", callback_data=f"pag:{self.tipo}:{cache.version:x}:{anterior}:{consulta}"))
+            if fin < len(posiciones):
+                botones.append(InlineKeyboardButton(
+                    "➡️ Ver más", callback_data=f"pag:{self.tipo}:{cache.version:x}:{fin}:{consulta}"))
+            renderizada = (texto, InlineKeyboardMarkup([botones]) if botones else None)
+        self._guardar(self.paginas, clave, renderizada)
+        return renderizada
+
+PAGINADORES = {
+    "o": Paginador("o", "ofertas", formatear_oferta, cache_ofertas),
+    "c": Paginador("c", "candidatos", formatear_candidato, cache_candidatos),
+}
+
+async def mostrar_busqueda(update: Update, context: CallbackContext, tipo: str):
+    paginador = PAGINADORES[tipo]
+    cache = paginador.cache
+    logger.info(f"Iniciando búsqueda de {paginador.nombre}")
+    if not cache:
+        await update.message.reply_text(f"Error al acceder a {paginador.nombre}")
         return
     
-    ofertas = ofertas_db.get_all_records()
-    logger.info(f"Se encontraron {len(ofertas)} ofertas")
-    if not ofertas:
-        await update.message.reply_text("No hay ofertas disponibles")
+    try:
+        await cache.obtener()
+    except Exception as e:
+        logger.error(f"Error leyendo {paginador.nombre}: {e}")
+        await update.message.reply_text(f"Error al acceder a {paginador.nombre}")
         return
     
-    # Mostrar primeras ofertas
-    inicio = 0
-    fin = RESULTADOS_POR_PAGINA
-    ofertas_pagina = ofertas[inicio:fin]
-    
-    mensaje = ""
-    for oferta in reversed(ofertas_pagina):
-        mensaje += (
-            f"💼 {oferta['Puesto']}\n"
-            f"🏢 {oferta['Empresa']}\n"
-            f"💰 {oferta['Salario']}\n"
-            f"📞 {oferta['Contacto']}\n\n"
-        )
-    
-    # Crear teclado con botón "Ver más" si hay más resultados
-    keyboard = []
-    if len(ofertas) > fin:
-        keyboard.append([InlineKeyboardButton("➡️ Ver más", callback_data="ver_mas_ofertas")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-    await update.message.reply_text(
-        mensaje or "No hay ofertas para mostrar",
-        reply_markup=reply_markup
-    )
+    # Búsqueda por palabras, p. ej. /buscar cocinero
+    consulta = paginador.consulta_compacta(" ".join(context.args), cache.version) if context.args else ""
+    if consulta:
+        anotar_busqueda(consulta)
+    logger.info(f"Se encontraron {len(cache.registros)} {paginador.nombre} (consulta: '{consulta}')")
+    texto, reply_markup = paginador.pagina(consulta, 0)
+    await update.message.reply_text(texto, reply_markup=reply_markup)
 
-async def buscar_candidatos(update: Update, context: CallbackContext):
-    context.user_data['pagina_candidatos'] = 0  # Inicializar en 0 para la primera página
-    logger.info("Iniciando búsqueda de candidatos")
-    if not candidatos_db:
-        await update.message.reply_text("Error al acceder a candidatos")
+async def buscar_ofertas(update: Update, context: CallbackContext):
+    await mostrar_busqueda(update, context, "o")
+
+# Búsqueda inline (@bot consulta)
+# Solo se usa lo que ya hay en la caché de ofertas: escribir nunca provoca una
+# lectura de la hoja. Las búsquedas comparten la LRU del paginador y las
+# páginas de resultados ya construidas se guardan en su propia LRU.
+class BusquedaInline:
+    def __init__(self, paginador: Paginador, max_paginas: int = PAGINAS_EN_CACHE):
+        self.paginador = paginador
+        self.max_paginas = max_paginas
+        self.paginas = OrderedDict()
+        self.ultima = {}  # user_id -> id de su última consulta
+
+    def pagina(self, consulta: str, inicio: int):
+        cache = self.paginador.cache
+        clave = (cache.version, consulta, inicio)
+        if clave in self.paginas:
+            metricas.contar("empleo_cache_total", cache="inline", resultado="acierto")
+            self.paginas.move_to_end(clave)
+            return self.paginas[clave]
+        metricas.contar("empleo_cache_total", cache="inline", resultado="fallo")
+        # Sin consulta, las más recientes primero
+        fin = inicio + RESULTADOS_INLINE
+        posiciones = self.paginador.buscar(consulta, fin + 1) if consulta else range(len(cache.registros) - 1, -1, -1)
+        resultados = []
+        for doc in posiciones[inicio:fin]:
+            oferta = cache.registros[doc]
+            resultados.append(InlineQueryResultArticle(
+                id=f"{cache.version:x}-{doc}",
+                title=f"💼 {oferta.get('Puesto', '')}",
+                description=" · ".join(v for v in (oferta.get('Empresa', ''), oferta.get('Salario', '')) if v),
+                input_message_content=InputTextMessageContent(formatear_oferta(oferta))
+            ))
+        pagina = (resultados, str(fin) if fin < len(posiciones) else "")
+        self.paginas[clave] = pagina
+        if len(self.paginas) > self.max_paginas:
+            self.paginas.popitem(last=False)
+        return pagina
+
+busqueda_inline = BusquedaInline(PAGINADORES["o"])
+
+async def consulta_inline(update: Update, context: CallbackContext):
+    consulta_recibida = update.inline_query
+    user_id = consulta_recibida.from_user.id
+    # Esperar un poco: si mientras tanto llega otra consulta del mismo usuario,
+    # esta ya no hace falta
+    busqueda_inline.ultima[user_id] = consulta_recibida.id
+    await asyncio.sleep(RETARDO_INLINE)
+    if busqueda_inline.ultima.get(user_id) != consulta_recibida.id:
         return
+    del busqueda_inline.ultima[user_id]
     
-    candidatos = candidatos_db.get_all_records()
-    logger.info(f"Se encontraron {len(candidatos)} candidatos")
-    if not candidatos:
-        await update.message.reply_text("No hay candidatos registrados")
+    if cache_ofertas.cargado_en is None:
+        # Aún sin datos en memoria: respuesta vacía que Telegram no guarde
+        await consulta_recibida.answer([], cache_time=0)
         return
-    
-    # Mostrar primeros candidatos
-    inicio = 0
-    fin = RESULTADOS_POR_PAGINA
-    candidatos_pagina = candidatos[inicio:fin]
-    
-    mensaje = ""
-    for candidato in reversed(candidatos_pagina):
-        mensaje += (
-            f"👤 {candidato['Nombre']}\n"
-            f"🛠️ {candidato['Trabajo']}\n"
-            f"📞 {candidato['Contacto']}\n\n"
-        )
-    
-    # Crear teclado con botón "Ver más" si hay más resultados
-    keyboard = []
-    if len(candidatos) > fin:
-        keyboard.append([InlineKeyboardButton("➡️ Ver más", callback_data="ver_mas_candidatos")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-    await update.message.reply_text(
-        mensaje or "No hay candidatos para mostrar",
-        reply_markup=reply_markup
-    )
+    consulta = " ".join(tokenizar(consulta_recibida.query))
+    inicio = int(consulta_recibida.offset) if consulta_recibida.offset.isdigit() else 0
+    resultados, siguiente = busqueda_inline.pagina(consulta, inicio)
+    try:
+        await consulta_recibida.answer(resultados, cache_time=CACHE_INLINE, next_offset=siguiente)
+    except BadRequest as e:
+        # La consulta caducó mientras se respondía
+        logger.warning(f"No se pudo responder la consulta inline de {user_id}: {e}")
+
+async def buscar_candidatos(update: Update, context: CallbackContext):
+    await mostrar_busqueda(update, context, "c")
 
-# Paginación
-async def ver_mas_ofertas(update: Update, context: CallbackContext):
+async def ver_pagina(update: Update, context: CallbackContext, datos: str = None):
     query = update.callback_query
-    await query.answer()
-    logger.info("Procesando ver_mas_ofertas")
-    
-    # Incrementar página
-    pagina = context.user_data.get('pagina_ofertas', 0) + 1
-    context.user_data['pagina_ofertas'] = pagina
-    logger.info(f"Mostrando página {pagina} de ofertas")
-    
-    if not ofertas_db:
-        await query.message.edit_text("Error al acceder a ofertas")
+    datos = datos or query.data
+    try:
+        _, tipo, version, inicio, consulta = datos.split(":", 4)
+        paginador = PAGINADORES[tipo]
+        inicio = int(inicio)
+    except (ValueError, KeyError):
+        logger.warning(f"callback_data de paginación inválido: {datos}")
         return
-    
-    ofertas = ofertas_db.get_all_records()
-    if not ofertas:
-        await query.message.edit_text("No hay más ofertas disponibles")
-        context.user_data['pagina_ofertas'] = 0
+    cache = paginador.cache
+    if not cache:
+        await query.message.edit_text(f"Error al acceder a {paginador.nombre}")
         return
     
-    # Calcular índices
-    inicio = pagina * RESULTADOS_POR_PAGINA
-    fin = inicio + RESULTADOS_POR_PAGINA
-    ofertas_pagina = ofertas[inicio:fin]
-    logger.info(f"Ofertas en página {pagina}: {len(ofertas_pagina)}")
-    
-    if not ofertas_pagina:
-        await query.message.edit_text("No hay más ofertas para mostrar")
-        context.user_data['pagina_ofertas'] = 0
-        return
-    
-    # Construir mensaje
-    mensaje = ""
-    for oferta in reversed(ofertas_pagina):
-        mensaje += (
-            f"💼 {oferta['Puesto']}\n"
-            f"🏢 {oferta['Empresa']}\n"
-            f"💰 {oferta['Salario']}\n"
-            f"📞 {oferta['Contacto']}\n\n"
-        )
-    
-    # Actualizar teclado
-    keyboard = []
-    if fin < len(ofertas):
-        keyboard.append([InlineKeyboardButton("➡️ Ver más", callback_data="ver_mas_ofertas")])
+    try:
+        await cache.obtener()
+    except Exception as e:
+        logger.error(f"Error leyendo {paginador.nombre}: {e}")
+        await query.message.edit_text(f"Error al acceder a {paginador.nombre}")
+        return
+    if version != f"{cache.version:x}":
+        # Los datos cambiaron desde que se envió el mensaje: se muestra la misma
+        # posición con los datos actuales
+        logger.info(f"Página de {paginador.nombre} con versión antigua {version}")
+    logger.info(f"Mostrando {paginador.nombre} desde la posición {inicio}")
     
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    texto, reply_markup = paginador.pagina(consulta, inicio)
     try:
-        await query.message.edit_text(
-            mensaje or "No hay más ofertas para mostrar",
-            reply_markup=reply_markup
-        )
+        await query.message.edit_text(texto, reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Error editando mensaje: {e}")
-        await query.message.reply_text(
-            mensaje or "No hay más ofertas para mostrar",
-            reply_markup=reply_markup
-        )
+        await query.message.reply_text(texto, reply_markup=reply_markup)
+
+# Candidatos para una oferta
+# Se ordenan por similitud TF-IDF entre el puesto y la descripción de la
+# oferta y el trabajo y la escolaridad de cada candidato. Como en la
+# paginación, el ID de la oferta y la posición viajan en el callback_data:
+# "cand:<id>" abre un mensaje nuevo y "cand:<id>:<inicio>" lo pagina.
+CAMPOS_OFERTA_CANDIDATOS = {"Puesto": 2, "Descripcion": 1}
+
+def boton_candidatos(oferta_id: str) -> InlineKeyboardButton:
+    return InlineKeyboardButton("👥 Candidatos para mi oferta", callback_data=f"cand:{oferta_id}")
+
+def pagina_candidatos(oferta: dict, inicio: int):
+    # Se pide uno más de los que caben para saber si hay otra página
+    fin = inicio + RESULTADOS_POR_PAGINA
+    docs = cache_candidatos.vectores.similares(oferta, CAMPOS_OFERTA_CANDIDATOS, fin + 1)
+    seleccion = [cache_candidatos.registros[doc] for doc in docs[inicio:fin]]
+    if not seleccion:
+        if inicio:
+            return "No hay más candidatos para esta oferta", None
+        return f"Todavía no hay candidatos que encajen con «{oferta.get('Puesto', '')}»", None
+    texto = f"👥 Candidatos para «{oferta.get('Puesto', '')}»:\n\n" + "".join(formatear_candidato(c) for c in seleccion)
+    botones = []
+    if inicio > 0:
+        botones.append(InlineKeyboardButton(
+            "⬅️ Atrás", callback_data=f"cand:{oferta['ID']}:{max(0, inicio - RESULTADOS_POR_PAGINA)}"))
+    if len(docs) > fin:
+        botones.append(InlineKeyboardButton("➡️ Ver más", callback_data=f"cand:{oferta['ID']}:{fin}"))
+    return texto, InlineKeyboardMarkup([botones]) if botones else None
 
-async def ver_mas_candidatos(update: Update, context: CallbackContext):
+async def candidatos_para_oferta(update: Update, context: CallbackContext):
     query = update.callback_query
-    await query.answer()
-    logger.info("Procesando ver_mas_candidatos")
-    
-    # Incrementar página
-    pagina = context.user_data.get('pagina_candidatos', 0) + 1
-    context.user_data['pagina_candidatos'] = pagina
-    logger.info(f"Mostrando página {pagina} de candidatos")
-    
-    if not candidatos_db:
-        await query.message.edit_text("Error al acceder a candidatos")
+    partes = query.data.split(":")
+    oferta_id = partes[1] if len(partes) > 1 else ""
+    inicio = int(partes[2]) if len(partes) > 2 and partes[2].isdigit() else None
+    if not cache_ofertas or not cache_candidatos:
+        await query.message.reply_text("Error al acceder a los candidatos")
         return
-    
-    candidatos = candidatos_db.get_all_records()
-    if not candidatos:
-        await query.message.edit_text("No hay más candidatos disponibles")
-        context.user_data['pagina_candidatos'] = 0
+    try:
+        ofertas, _ = await asyncio.gather(cache_ofertas.obtener(), cache_candidatos.obtener())
+    except Exception as e:
+        logger.error(f"Error leyendo ofertas o candidatos: {e}")
+        await query.message.reply_text("Error al acceder a los candidatos")
         return
-    
-    # Calcular índices
-    inicio = pagina * RESULTADOS_POR_PAGINA
-    fin = inicio + RESULTADOS_POR_PAGINA
-    candidatos_pagina = candidatos[inicio:fin]
-    logger.info(f"Candidatos en página {pagina}: {len(candidatos_pagina)}")
-    
-    if not candidatos_pagina:
-        await query.message.edit_text("No hay más candidatos para mostrar")
-        context.user_data['pagina_candidatos'] = 0
+    # Las ofertas nuevas van al final: buscar desde ahí
+    oferta = next((o for o in reversed(ofertas) if o.get("ID") == oferta_id), None)
+    if not oferta:
+        await query.message.reply_text("Esa oferta ya no está publicada.")
         return
     
-    # Construir mensaje
-    mensaje = ""
-    for candidato in reversed(candidatos_pagina):
-        mensaje += (
-            f"👤 {candidato['Nombre']}\n"
-            f"🛠️ {candidato['Trabajo']}\n"
-            f"📞 {candidato['Contacto']}\n\n"
-        )
-    
-    # Actualizar teclado
-    keyboard = []
-    if fin < len(candidatos):
-        keyboard.append([InlineKeyboardButton("➡️ Ver más", callback_data="ver_mas_candidatos")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    texto, reply_markup = pagina_candidatos(oferta, inicio or 0)
+    if inicio is None:
+        await query.message.reply_text(texto, reply_markup=reply_markup)
+        return
     try:
-        await query.message.edit_text(
-            mensaje or "No hay más candidatos para mostrar",
-            reply_markup=reply_markup
-        )
+        await query.message.edit_text(texto, reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Error editando mensaje: {e}")
-        await query.message.reply_text(
-            mensaje or "No hay más candidatos para mostrar",
-            reply_markup=reply_markup
-        )
+        await query.message.reply_text(texto, reply_markup=reply_markup)
+
+async def mis_ofertas(update: Update, context: CallbackContext):
+    if not cache_ofertas:
+        await update.message.reply_text("Error al acceder a las ofertas")
+        return
+    try:
+        ofertas = await cache_ofertas.obtener()
+    except Exception as e:
+        logger.error(f"Error leyendo ofertas: {e}")
+        await update.message.reply_text("Error al acceder a las ofertas")
+        return
+    
+    user_id = str(update.effective_user.id)
+    propias = list(itertools.islice((o for o in reversed(ofertas) if o.get("UserID") == user_id), MAX_MIS_OFERTAS))
+    if not propias:
+        await update.message.reply_text("No tienes ofertas publicadas. Usa /menu para publicar una.")
+        return
+    keyboard = [
+        [InlineKeyboardButton(f"👥 {o.get('Puesto', '')[:40]} ({o.get('Fecha', '')})", callback_data=f"cand:{o['ID']}")]
+        for o in propias
+    ]
+    await update.message.reply_text(
+        "💼 Tus ofertas publicadas. Pulsa una para ver los candidatos que mejor encajan:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
 # ConversationHandler para oferta
 async def iniciar_oferta(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
+    context.user_data['oferta'] = {}
     await query.message.reply_text("💼 Ingresa el puesto de trabajo:")
     return PUESTO
 
@@ -391,10 +2187,28 @@ async def guardar_descripcion(update: Update, context: CallbackContext):
 async def guardar_contacto(update: Update, context: CallbackContext):
     context.user_data['oferta']['contacto'] = update.message.text
     user_id = update.effective_user.id
-    if nueva_oferta(user_id, context.user_data['oferta']):
-        await update.message.reply_text("✅ Oferta registrada con éxito.")
+    repetida = await oferta_repetida(context.user_data['oferta'])
+    if repetida:
+        await update.message.reply_text(
+            f"⚠️ Ya hay publicada una oferta casi igual (ID {repetida.get('ID', '')}, "
+            f"{repetida.get('Fecha', '')}). No se ha vuelto a publicar."
+        )
+        context.user_data.clear()
+        return ConversationHandler.END
+    fila = await nueva_oferta(user_id, context.user_data['oferta'])
+    if fila:
+        await update.message.reply_text(
+            "✅ Oferta registrada con éxito.",
+            reply_markup=InlineKeyboardMarkup([[boton_candidatos(fila[0])]])
+        )
+        await notificar_alertas(context, dict(zip(cache_ofertas.encabezados or ENCABEZADOS["Ofertas"], fila)), user_id)
     else:
-        await update.message.reply_text("❌ Error al registrar la oferta.")
+        # Conservar lo ya escrito: reenviar el contacto vuelve a intentarlo
+        await update.message.reply_text(
+            "❌ Error al registrar la oferta. Tus datos se han guardado: envía de nuevo el contacto "
+            "para reintentarlo o /cancelar para descartarla."
+        )
+        return CONTACTO
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -402,6 +2216,7 @@ async def guardar_contacto(update: Update, context: CallbackContext):
 async def iniciar_registro(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
+    context.user_data['candidato'] = {}
     await query.message.reply_text("👤 Ingresa tu nombre completo:")
     return NOMBRE
 
@@ -423,19 +2238,328 @@ async def guardar_escolaridad(update: Update, context: CallbackContext):
 async def guardar_contacto_trabajador(update: Update, context: CallbackContext):
     context.user_data['candidato']['contacto'] = update.message.text
     user_id = update.effective_user.id
-    if nuevo_candidato(user_id, context.user_data['candidato']):
-        await update.message.reply_text("✅ Registro como candidato completado.")
+    if await nuevo_candidato(user_id, context.user_data['candidato']):
+        motor_alertas.interesar(str(user_id), context.user_data['candidato']['trabajo'])
+        await update.message.reply_text(
+            "✅ Registro como candidato completado.\n"
+            "🔔 Te avisaremos cuando se publique una oferta de ese trabajo. Usa /alerta para ver o cambiar tus avisos."
+        )
     else:
-        await update.message.reply_text("❌ Error al registrar candidato.")
+        await update.message.reply_text(
+            "❌ Error al registrar candidato. Tus datos se han guardado: envía de nuevo el contacto "
+            "para reintentarlo o /cancelar para descartarlo."
+        )
+        return CONTACTO_TRABAJADOR
     context.user_data.clear()
     return ConversationHandler.END
 
+# Alertas de nuevas ofertas
+# Palabras de /alerta y del trabajo que buscan los candidatos, compiladas en un
+# índice palabra -> usuarios: encontrar a quién avisar cuesta lo que las
+# coincidencias, no lo que el número de suscriptores.
+class MotorAlertas:
+    def __init__(self):
+        self.por_alerta = defaultdict(set)  # palabra de /alerta -> usuarios
+        self.por_interes = defaultdict(set)  # palabra del trabajo buscado -> candidatos
+        self.alertas = defaultdict(set)  # usuario -> palabras de /alerta
+        self.silenciados = set()
+        self.cargado = False
+
+    def suscribir(self, user_id: str, palabras: str):
+        for termino in tokenizar(palabras):
+            self.alertas[user_id].add(termino)
+            self.por_alerta[termino].add(user_id)
+
+    def interesar(self, user_id: str, trabajo: str):
+        for termino in tokenizar(trabajo):
+            self.por_interes[termino].add(user_id)
+
+    def olvidar(self, user_id: str):
+        for termino in self.alertas.pop(user_id, set()):
+            self.por_alerta[termino].discard(user_id)
+        self.silenciados.discard(user_id)
+
+    def cargar(self, alertas: list, candidatos: list):
+        self.__init__()
+        for fila in alertas:
+            if len(fila) < 2 or not fila[0]:
+                continue
+            if fila[1] == ALERTAS_SILENCIADAS:
+                self.silenciados.add(fila[0])
+            else:
+                self.suscribir(fila[0], fila[1])
+        for candidato in candidatos:
+            self.interesar(str(candidato.get("UserID", "")), candidato.get("Trabajo", ""))
+        self.cargado = True
+
+    def coincidencias(self, oferta: dict) -> set:
+        usuarios = set()
+        interesados = set()
+        for termino in set(tokenizar(f"{oferta.get('Puesto', '')} {oferta.get('Descripcion', '')}")):
+            usuarios |= self.por_alerta.get(termino, set())
+            interesados |= self.por_interes.get(termino, set())
+        return usuarios | (interesados - self.silenciados)
+
+motor_alertas = MotorAlertas()
+alertas_db = almacen.tabla("Alertas", crear=True) if almacen else None
+# Borrar y volver a escribir las filas de un usuario no puede intercalarse con
+# otro cambio: los borrados van por posición y las filas se desplazan
+escritura_alertas = asyncio.Lock()
+
+async def cargar_alertas():
+    if not alertas_db:
+        return
+    filas = await llamar_almacen(alertas_db.leer_todo)
+    candidatos = await cache_candidatos.obtener() if cache_candidatos else []
+    motor_alertas.cargar(filas[1:], candidatos)
+    logger.info(f"Alertas cargadas: {len(motor_alertas.alertas)} suscriptores, {len(motor_alertas.silenciados)} silenciados")
+
+async def borrar_alertas_usuario(user_id: str):
+    # Llamar con escritura_alertas tomado
+    await llamar_almacen(alertas_db.borrar_donde, 1, user_id)
+    motor_alertas.olvidar(user_id)
+
+async def alerta(update: Update, context: CallbackContext):
+    user_id = str(update.effective_user.id)
+    try:
+        if alertas_db and not motor_alertas.cargado:
+            await cargar_alertas()
+    except Exception as e:
+        logger.error(f"Error cargando alertas: {e}")
+    if not motor_alertas.cargado:
+        await update.message.reply_text("Error al acceder a las alertas")
+        return
+    
+    if not context.args:
+        palabras = sorted(motor_alertas.alertas.get(user_id, set()))
+        estado = "🔕 desactivados" if user_id in motor_alertas.silenciados else "🔔 activos"
+        await update.message.reply_text(
+            f"Avisos {estado}.\n"
+            f"Palabras: {', '.join(palabras) if palabras else 'ninguna'}\n\n"
+            "Usa /alerta <palabras> para recibir las ofertas que las mencionen "
+            "o /alerta borrar para dejar de recibir avisos."
+        )
+        return
+    
+    try:
+        if context.args[0].lower() == "borrar":
+            async with escritura_alertas:
+                await borrar_alertas_usuario(user_id)
+                await llamar_almacen(alertas_db.agregar_filas, [[user_id, ALERTAS_SILENCIADAS, datetime.now().strftime("%Y-%m-%d")]])
+                motor_alertas.silenciados.add(user_id)
+            await update.message.reply_text("🔕 Ya no recibirás avisos de nuevas ofertas.")
+            return
+        
+        palabras = " ".join(tokenizar(" ".join(context.args)))
+        if not palabras:
+            await update.message.reply_text("📝 Indica alguna palabra. Ejemplo: /alerta cocinero")
+            return
+        async with escritura_alertas:
+            if user_id in motor_alertas.silenciados:
+                # Reactivar: quitar la marca de silencio conservando sus palabras
+                palabras = " ".join(sorted(motor_alertas.alertas.get(user_id, set()) | set(palabras.split())))
+                await borrar_alertas_usuario(user_id)
+            await llamar_almacen(alertas_db.agregar_filas, [[user_id, palabras, datetime.now().strftime("%Y-%m-%d")]])
+            motor_alertas.suscribir(user_id, palabras)
+        await update.message.reply_text(f"🔔 Te avisaremos cuando se publique una oferta con: {palabras.replace(' ', ', ')}")
+    except Exception as e:
+        logger.error(f"Error guardando alerta de {user_id}: {e}")
+        await update.message.reply_text("❌ Error al guardar la alerta.")
+
+async def notificar_alertas(context: CallbackContext, oferta: dict, autor: int):
+    destinos = [int(u) for u in motor_alertas.coincidencias(oferta) if u != str(autor) and u.isdigit()]
+    if not destinos:
+        return
+    difusion = Difusion(
+        context.bot,
+        destinos,
+        "🔔 Nueva oferta que coincide con tus avisos:\n\n" + formatear_oferta(oferta) + "Usa /alerta borrar para no recibir más avisos.",
+        limitador_envios
+    )
+    logger.info(f"Avisando de la oferta {oferta.get('ID')} a {len(destinos)} usuarios")
+    context.application.create_task(ejecutar_alertas(difusion))
+
+async def ejecutar_alertas(difusion):
+    await difusion.ejecutar()
+    logger.info(f"Avisos enviados: {difusion.enviados}, fallidos: {difusion.fallidos}")
+    if registro_usuarios and difusion.bloqueados:
+        try:
+            await marcar_inactivos([
+                registro_usuarios.filas[str(chat)] for chat in difusion.bloqueados if str(chat) in registro_usuarios.filas
+            ])
+        except Exception as e:
+            logger.error(f"Error marcando usuarios inactivos: {e}")
+
 # Comando para cancelar
 async def cancelar(update: Update, context: CallbackContext):
     await update.message.reply_text("Acción cancelada. Usa /menu para continuar.")
     context.user_data.clear()
     return ConversationHandler.END
 
+# Difusión de mensajes masivos
+# Telegram admite unos 30 mensajes/s en total y 1 mensaje/s por chat
+class LimitadorEnvios:
+    def __init__(self, tasa_global: float = LIMITE_ENVIOS_GLOBAL, intervalo_chat: float = 1.0):
+        self.tasa = tasa_global
+        self.capacidad = tasa_global
+        self.tokens = tasa_global
+        self.ultimo = time.monotonic()
+        self.pausa_hasta = 0.0
+        self.intervalo_chat = intervalo_chat
+        self.ultimo_por_chat = {}
+        self._lock = asyncio.Lock()
+
+    def pausar(self, segundos: float):
+        # RetryAfter de Telegram: detener todos los envíos durante ese tiempo
+        self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + segundos)
+
+    async def esperar(self, chat_id: int):
+        async with self._lock:
+            while True:
+                ahora = time.monotonic()
+                if ahora < self.pausa_hasta:
+                    await asyncio.sleep(self.pausa_hasta - ahora)
+                    continue
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+                self.ultimo = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.tasa)
+            espera_chat = self.ultimo_por_chat.get(chat_id, 0.0) + self.intervalo_chat - ahora
+            self.ultimo_por_chat[chat_id] = max(ahora, ahora + espera_chat)
+            if len(self.ultimo_por_chat) > 10000:
+                # Olvidar los chats que ya no están dentro del intervalo
+                self.ultimo_por_chat = {c: t for c, t in self.ultimo_por_chat.items() if t > ahora - self.intervalo_chat}
+        if espera_chat > 0:
+            await asyncio.sleep(espera_chat)
+
+limitador_envios = LimitadorEnvios()
+
+class Difusion:
+    def __init__(self, bot, destinos: list, texto: str, limitador: LimitadorEnvios,
+                 simultaneos: int = ENVIOS_SIMULTANEOS, max_reintentos: int = 3):
+        self.bot = bot
+        self.destinos = destinos
+        self.texto = texto
+        self.limitador = limitador
+        self.simultaneos = simultaneos
+        self.max_reintentos = max_reintentos
+        self.enviados = 0
+        self.fallidos = 0
+        self.bloqueados = []
+        self.cancelada = False
+        self.inicio = None
+
+    @property
+    def procesados(self):
+        return self.enviados + self.fallidos
+
+    def cancelar(self):
+        self.cancelada = True
+
+    async def _enviar(self, chat_id: int):
+        for intento in range(self.max_reintentos + 1):
+            await self.limitador.esperar(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=self.texto)
+                self.enviados += 1
+                metricas.contar("empleo_envios_total", resultado="ok")
+                return
+            except RetryAfter as e:
+                logger.warning(f"Límite de Telegram alcanzado, esperando {e.retry_after}s")
+                metricas.contar("empleo_envios_total", resultado="limitado")
+                self.limitador.pausar(e.retry_after)
+            except Forbidden:
+                # El usuario bloqueó al bot o borró su cuenta
+                self.bloqueados.append(chat_id)
+                self.fallidos += 1
+                metricas.contar("empleo_envios_total", resultado="bloqueado")
+                return
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    self.bloqueados.append(chat_id)
+                logger.error(f"Error enviando mensaje a {chat_id}: {e}")
+                self.fallidos += 1
+                metricas.contar("empleo_envios_total", resultado="error")
+                return
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Error de red enviando a {chat_id} (intento {intento + 1}): {e}")
+                metricas.contar("empleo_envios_total", resultado="reintento")
+                await asyncio.sleep(2 ** intento)
+            except Exception as e:
+                logger.error(f"Error enviando mensaje a {chat_id}: {e}")
+                self.fallidos += 1
+                metricas.contar("empleo_envios_total", resultado="error")
+                return
+        self.fallidos += 1
+        metricas.contar("empleo_envios_total", resultado="error")
+
+    async def _trabajador(self, cola: asyncio.Queue):
+        while not self.cancelada:
+            try:
+                chat_id = cola.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await self._enviar(chat_id)
+
+    async def ejecutar(self):
+        self.inicio = time.monotonic()
+        cola = asyncio.Queue()
+        for chat_id in self.destinos:
+            cola.put_nowait(chat_id)
+        await asyncio.gather(*(self._trabajador(cola) for _ in range(min(self.simultaneos, len(self.destinos)))))
+
+    def resumen(self):
+        texto = f"📬 Mensaje enviado a {self.enviados} usuarios. "
+        if self.fallidos:
+            texto += f"No se pudo enviar a {self.fallidos} usuarios. "
+        if self.bloqueados:
+            texto += f"{len(self.bloqueados)} marcados como inactivos. "
+        if self.cancelada:
+            texto += f"Envío cancelado ({len(self.destinos) - self.procesados} sin enviar)."
+        return texto.strip()
+
+async def marcar_inactivos(filas: list):
+    # Una sola escritura para todos los chats que bloquearon al bot
+    if not filas:
+        return
+    await llamar_almacen(usuarios_db.actualizar_celdas, [(fila, 7, "inactivo") for fila in filas])
+    if registro_usuarios:
+        registro_usuarios.inactivos.update(filas)
+    logger.info(f"{len(filas)} usuarios marcados como inactivos")
+
+async def ejecutar_difusion(difusion: Difusion, filas_por_chat: dict, estado, context: CallbackContext):
+    teclado = InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Cancelar envío", callback_data="cancelar_envio")]])
+
+    async def informar():
+        while True:
+            await asyncio.sleep(INTERVALO_PROGRESO_ENVIO)
+            try:
+                await estado.edit_text(
+                    f"📤 Enviando... {difusion.procesados}/{len(difusion.destinos)} "
+                    f"({difusion.enviados} enviados, {difusion.fallidos} fallidos)",
+                    reply_markup=teclado
+                )
+            except Exception as e:
+                logger.warning(f"No se pudo actualizar el progreso del envío: {e}")
+
+    progreso = asyncio.create_task(informar())
+    try:
+        await difusion.ejecutar()
+    finally:
+        progreso.cancel()
+        context.bot_data.pop('difusion', None)
+    logger.info(
+        f"Difusión terminada en {time.monotonic() - difusion.inicio:.1f}s: "
+        f"{difusion.enviados} enviados, {difusion.fallidos} fallidos"
+    )
+    try:
+        await marcar_inactivos([filas_por_chat[c] for c in difusion.bloqueados if c in filas_por_chat])
+    except Exception as e:
+        logger.error(f"Error marcando usuarios inactivos: {e}")
+    await estado.edit_text(difusion.resumen())
+
 # Comando para enviar mensajes masivos
 async def enviar_mensaje(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
@@ -447,29 +2571,158 @@ async def enviar_mensaje(update: Update, context: CallbackContext):
         await update.message.reply_text("📝 Por favor, proporciona el mensaje a enviar. Ejemplo: /enviar Hola a todos")
         return
     
+    if context.bot_data.get('difusion'):
+        await update.message.reply_text("⏳ Ya hay un envío en curso. Usa /cancelarenvio para detenerlo.")
+        return
+    
     mensaje = " ".join(context.args)
-    usuarios = usuarios_db.get_all_records()
+    try:
+        # Escribir antes los usuarios pendientes para que también reciban el mensaje
+        await registro_usuarios.volcar()
+        usuarios = await llamar_almacen(usuarios_db.leer_todo)
+    except Exception as e:
+        logger.error(f"Error leyendo usuarios: {e}")
+        await update.message.reply_text("❌ Error al acceder a los usuarios.")
+        return
+    
+    # Columnas: 4 = ChatID, 7 = estado. La fila 1 son los encabezados
+    filas_por_chat = {}
+    for fila, usuario in enumerate(usuarios[1:], start=2):
+        if len(usuario) < 4 or not usuario[3].strip().lstrip('-').isdigit():
+            continue
+        if len(usuario) >= 7 and usuario[6] == "inactivo":
+            continue
+        filas_por_chat.setdefault(int(usuario[3]), fila)
     
-    if not usuarios:
+    if not filas_por_chat:
         await update.message.reply_text("No hay usuarios registrados.")
         return
     
-    enviados = 0
-    fallidos = 0
-    for usuario in usuarios:
+    difusion = Difusion(context.bot, list(filas_por_chat), mensaje, limitador_envios)
+    context.bot_data['difusion'] = difusion
+    estado = await update.message.reply_text(
+        f"📤 Enviando mensaje a {len(filas_por_chat)} usuarios...",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Cancelar envío", callback_data="cancelar_envio")]])
+    )
+    # El envío corre en segundo plano: el bot sigue atendiendo a los demás
+    context.application.create_task(ejecutar_difusion(difusion, filas_por_chat, estado, context))
+
+async def cancelar_envio(update: Update, context: CallbackContext):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    difusion = context.bot_data.get('difusion')
+    if not difusion:
+        await update.effective_message.reply_text("No hay ningún envío en curso.")
+        return
+    difusion.cancelar()
+    await update.effective_message.reply_text("⛔ Cancelando envío...")
+
+async def estadisticas(update: Update, context: CallbackContext):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 Solo los administradores pueden usar este comando.")
+        return
+    
+    def populares(contador: Counter) -> str:
+        return ", ".join(f"{termino} ({n})" for termino, n in contador.most_common(5)) or "—"
+    
+    lineas = ["📊 Estadísticas", ""]
+    for nombre, cache in (("Ofertas", cache_ofertas), ("Candidatos", cache_candidatos)):
+        # Si la caché no está cargada se carga una vez; después se usa tal cual,
+        # sin obtener(), que relanzaría una lectura completa al caducar el TTL
+        if not cache:
+            continue
         try:
-            chat_id = int(usuario['ChatID'])
-            await context.bot.send_message(chat_id=chat_id, text=mensaje)
-            enviados += 1
-            time.sleep(0.05)  # Evitar límites de Telegram
+            if cache.cargado_en is None:
+                await cache.recargar()
         except Exception as e:
-            logger.error(f"Error enviando mensaje a {usuario['ChatID']}: {e}")
-            fallidos += 1
+            logger.error(f"Error leyendo {nombre.lower()} para /stats: {e}")
+            lineas += [f"{nombre}: no disponible", ""]
+            continue
+        agregados = cache.agregados
+        lineas += [
+            f"{'💼' if nombre == 'Ofertas' else '👤'} {nombre}: {len(cache.registros)} en total",
+            f"Hoy: {agregados.en_dias(1)} · Últimos 7 días: {agregados.en_dias(7)} · Semana anterior: {agregados.en_dias(14, 7)}",
+            "Por día: " + ", ".join(
+                f"{(datetime.now() - timedelta(days=d)).strftime('%d/%m')}: {agregados.en_dias(d + 1, d)}" for d in range(7)
+            ),
+            f"Más frecuentes: {populares(agregados.categorias)}",
+            ""
+        ]
+    if registro_usuarios and registro_usuarios.cargado:
+        total = len(registro_usuarios.filas) + len(registro_usuarios.nuevos)
+        inactivos = len(registro_usuarios.inactivos)
+        lineas.append(f"🧑‍🤝‍🧑 Usuarios: {total} ({total - inactivos} activos, {inactivos} inactivos)")
+    lineas.append(f"🔍 Más buscado: {populares(terminos_buscados)}")
+    await update.message.reply_text("\n".join(lineas))
+
+async def importar(update: Update, context: CallbackContext):
+    # Se usa enviando el fichero con el texto "/importar ofertas" o
+    # respondiendo con ese comando a un fichero ya enviado
+    mensaje = update.message
+    if update.effective_user.id not in ADMIN_IDS:
+        await mensaje.reply_text("🚫 Solo los administradores pueden usar este comando.")
+        return
     
-    await update.message.reply_text(
-        f"📬 Mensaje enviado a {enviados} usuarios. "
-        f"{'No se pudo enviar a ' + str(fallidos) + ' usuarios.' if fallidos else ''}"
-    )
+    documento = mensaje.document or (mensaje.reply_to_message and mensaje.reply_to_message.document)
+    argumentos = (mensaje.caption or mensaje.text or "").lower().split()[1:]
+    tablas = tablas_transferibles()
+    if not documento or not argumentos or argumentos[0] not in tablas:
+        await mensaje.reply_text(
+            "📥 Envía un fichero .csv o .jsonl con el texto /importar ofertas (o candidatos), "
+            "o responde a un fichero con ese comando."
+        )
+        return
+    formato = formato_de(documento.file_name)
+    if formato not in FORMATOS:
+        await mensaje.reply_text("❌ El fichero debe ser .csv o .jsonl.")
+        return
+    
+    nombre = argumentos[0]
+    with tempfile.TemporaryDirectory() as carpeta:
+        ruta = os.path.join(carpeta, f"importacion.{formato}")
+        try:
+            archivo = await documento.get_file()
+            await archivo.download_to_drive(ruta)
+        except Exception as e:
+            logger.error(f"Error descargando el fichero a importar: {e}")
+            await mensaje.reply_text("❌ No se pudo descargar el fichero (máximo 20 MB).")
+            return
+        await mensaje.reply_text(f"⏳ Importando {nombre}...")
+        # utf-8-sig: los CSV guardados con Excel empiezan con BOM
+        with open(ruta, encoding="utf-8-sig", newline="") as f:
+            resumen = await importar_registros(f, formato, nombre, update.effective_user.id)
+    
+    lineas = [f"✅ Importación de {nombre}: {resumen['importadas']} filas importadas, {resumen['rechazadas']} rechazadas."]
+    lineas += resumen["errores"]
+    if resumen["fallo"]:
+        lineas.append(f"❌ La importación se detuvo por un error: {resumen['fallo']}")
+    await mensaje.reply_text("\n".join(lineas))
+
+async def exportar(update: Update, context: CallbackContext):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("🚫 Solo los administradores pueden usar este comando.")
+        return
+    
+    argumentos = [a.lower() for a in context.args]
+    formato = argumentos[1] if len(argumentos) > 1 else "csv"
+    if not argumentos or argumentos[0] not in tablas_transferibles() or formato not in FORMATOS:
+        await update.message.reply_text("📤 Uso: /exportar ofertas|candidatos [csv|jsonl]")
+        return
+    
+    nombre = argumentos[0]
+    # Escribir antes las altas del diario para que también salgan
+    await drenar_diario(None)
+    with tempfile.TemporaryDirectory() as carpeta:
+        ruta = os.path.join(carpeta, f"{nombre}_{datetime.now().strftime('%Y-%m-%d')}.{formato}")
+        try:
+            with open(ruta, "w", encoding="utf-8", newline="") as f:
+                total = await exportar_registros(f, formato, nombre)
+        except Exception as e:
+            logger.error(f"Error exportando {nombre}: {e}")
+            await update.message.reply_text(f"❌ Error al exportar {nombre}.")
+            return
+        with open(ruta, "rb") as f:
+            await update.message.reply_document(f, caption=f"📦 Exportación de {nombre}: {total} filas")
 
 # Manejador de botones
 async def handle_button(update: Update, context: CallbackContext):
@@ -479,25 +2732,328 @@ async def handle_button(update: Update, context: CallbackContext):
     
     if query.data == "buscar_ofertas":
         await buscar_ofertas(query, context)
-    elif query.data == "ofertar_trabajo":
-        await iniciar_oferta(query, context)
-    elif query.data == "registro_trabajador":
-        await iniciar_registro(query, context)
     elif query.data == "buscar_candidatos":
         await buscar_candidatos(query, context)
     elif query.data == "mostrar_ayuda":
         await ayuda(query, context)
+    elif query.data.startswith("pag:"):
+        await ver_pagina(update, context)
     elif query.data == "ver_mas_ofertas":
-        await ver_mas_ofertas(update, context)
+        # Botones de mensajes enviados antes de la paginación sin estado
+        await ver_pagina(update, context, f"pag:o:0:{RESULTADOS_POR_PAGINA}:")
     elif query.data == "ver_mas_candidatos":
-        await ver_mas_candidatos(update, context)
+        await ver_pagina(update, context, f"pag:c:0:{RESULTADOS_POR_PAGINA}:")
+    elif query.data == "cancelar_envio":
+        await cancelar_envio(update, context)
+    elif query.data.startswith("cand:"):
+        await candidatos_para_oferta(update, context)
+
+# Persistencia de conversaciones
+# Estado de oferta_conv/registro_conv y user_data en un SQLite local, para que
+# un reinicio no pierda las altas a medio rellenar. PTB entrega los cambios
+# cada INTERVALO_PERSISTENCIA segundos; se acumulan y se escriben en una sola
+# transacción desde un hilo aparte. Solo se guardan los usuarios con datos y
+# las conversaciones abiertas, así la carga al arrancar es pequeña.
+class PersistenciaSQLite(BasePersistence):
+    def __init__(self, ruta: str, intervalo: float = INTERVALO_PERSISTENCIA):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=intervalo
+        )
+        self.ruta = ruta
+        self.conn = None
+        self.guardados = {}  # user_id -> JSON que hay en disco
+        self.usuarios = {}  # user_id -> JSON por escribir (None para borrar)
+        self.conversaciones = {}  # (nombre, clave) -> estado por escribir (None para borrar)
+        self._escritura = None
+        self._hilo = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistencia")
+
+    def _abrir(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.ruta, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS usuarios (user_id INTEGER PRIMARY KEY, datos TEXT)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversaciones "
+                "(nombre TEXT, clave TEXT, estado TEXT, PRIMARY KEY (nombre, clave))"
+            )
+        return self.conn
+
+    async def _en_hilo(self, funcion, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._hilo, funcion, *args)
+
+    def _leer(self, consulta: str, *parametros) -> list:
+        return self._abrir().execute(consulta, parametros).fetchall()
+
+    def _guardar(self, usuarios: dict, conversaciones: dict):
+        conn = self._abrir()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO usuarios (user_id, datos) VALUES (?, ?)",
+                [(u, datos) for u, datos in usuarios.items() if datos]
+            )
+            conn.executemany("DELETE FROM usuarios WHERE user_id = ?", [(u,) for u, datos in usuarios.items() if not datos])
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversaciones (nombre, clave, estado) VALUES (?, ?, ?)",
+                [(n, c, estado) for (n, c), estado in conversaciones.items() if estado is not None]
+            )
+            conn.executemany(
+                "DELETE FROM conversaciones WHERE nombre = ? AND clave = ?",
+                [(n, c) for (n, c), estado in conversaciones.items() if estado is None]
+            )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    async def _escribir(self):
+        # Las llamadas de un mismo volcado de PTB llegan seguidas: se escribe
+        # cuando han llegado todas
+        await asyncio.sleep(0)
+        while self.usuarios or self.conversaciones:
+            usuarios, self.usuarios = self.usuarios, {}
+            conversaciones, self.conversaciones = self.conversaciones, {}
+            try:
+                await self._en_hilo(self._guardar, usuarios, conversaciones)
+            except Exception as e:
+                logger.error(f"Error guardando el estado de las conversaciones: {e}")
+                for clave, valor in usuarios.items():
+                    self.usuarios.setdefault(clave, valor)
+                for clave, valor in conversaciones.items():
+                    self.conversaciones.setdefault(clave, valor)
+                return
+
+    def _programar(self):
+        if self._escritura is None or self._escritura.done():
+            self._escritura = asyncio.create_task(self._escribir())
+
+    async def get_user_data(self) -> dict:
+        filas = await self._en_hilo(self._leer, "SELECT user_id, datos FROM usuarios")
+        self.guardados = dict(filas)
+        logger.info(f"Estado de {len(filas)} usuarios recuperado")
+        return {user_id: json.loads(datos) for user_id, datos in filas}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        datos = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        if self.guardados.get(user_id) == datos:
+            return
+        if datos:
+            self.guardados[user_id] = datos
+        else:
+            self.guardados.pop(user_id, None)
+        self.usuarios[user_id] = datos
+        self._programar()
+
+    async def drop_user_data(self, user_id: int):
+        await self.update_user_data(user_id, {})
+
+    async def get_conversations(self, name: str) -> dict:
+        filas = await self._en_hilo(self._leer, "SELECT clave, estado FROM conversaciones WHERE nombre = ?", name)
+        return {tuple(json.loads(clave)): json.loads(estado) for clave, estado in filas}
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        self.conversaciones[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._programar()
+
+    async def flush(self):
+        await self._escribir()
+        if self.conn is not None:
+            await self._en_hilo(self.conn.close)
+            self.conn = None
+
+    # Solo se guardan user_data y las conversaciones
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+# Procesamiento de actualizaciones
+# Varias actualizaciones a la vez, pero las de un mismo chat en orden. El
+# límite de concurrencia se aplica después de esperar el turno del chat, así
+# los mensajes en cola de un chat no ocupan los huecos de los demás.
+class ProcesadorPorChat(BaseUpdateProcessor):
+    def __init__(self, max_simultaneas: int):
+        super().__init__(max_simultaneas * 100)
+        self.limite = asyncio.Semaphore(max_simultaneas)
+        self.turnos = {}  # chat -> [lock, actualizaciones esperando]
+
+    async def do_process_update(self, update: object, coroutine):
+        chat = None
+        if isinstance(update, Update) and update.inline_query:
+            # Las consultas inline se resuelven en memoria y esperan antes de
+            # responder: ni turno por usuario ni hueco en el límite
+            await coroutine
+            return
+        if isinstance(update, Update):
+            if update.effective_chat:
+                chat = update.effective_chat.id
+            elif update.effective_user:
+                chat = update.effective_user.id
+        if chat is None:
+            async with self.limite:
+                await coroutine
+            return
+        turno = self.turnos.setdefault(chat, [asyncio.Lock(), 0])
+        turno[1] += 1
+        try:
+            async with turno[0]:
+                async with self.limite:
+                    await coroutine
+        finally:
+            turno[1] -= 1
+            if not turno[1]:
+                del self.turnos[chat]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Servidor de métricas
+# Un servidor HTTP local aparte en los dos modos, para que /metrics no quede
+# expuesto junto al webhook público
+servidor_metricas = None
+
+async def exportar_metricas(request: Request):
+    return Response(metricas.exportar(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def iniciar_servidor_metricas():
+    global servidor_metricas
+    if not PUERTO_METRICAS or servidor_metricas:
+        return
+    web = Starlette(routes=[Route("/metrics", exportar_metricas, methods=["GET"])])
+    servidor = uvicorn.Server(uvicorn.Config(
+        web, host=HOST_METRICAS, port=PUERTO_METRICAS, log_level="warning", lifespan="off"
+    ))
+    # Las señales las gestiona el bot, no este servidor
+    servidor.install_signal_handlers = lambda: None
+
+    async def servir():
+        try:
+            await servidor.serve()
+        except SystemExit:
+            # uvicorn sale así si el puerto está ocupado: el bot sigue sin métricas
+            logger.error(f"No se pudo abrir el servidor de métricas en {HOST_METRICAS}:{PUERTO_METRICAS}")
+
+    servidor_metricas = (servidor, asyncio.create_task(servir()))
+    logger.info(f"Métricas en http://{HOST_METRICAS}:{PUERTO_METRICAS}/metrics")
+
+async def parar_servidor_metricas():
+    global servidor_metricas
+    if servidor_metricas:
+        servidor, tarea = servidor_metricas
+        servidor.should_exit = True
+        await tarea
+        servidor_metricas = None
+
+# Modo webhook
+# Admite varias réplicas tras un balanceador: cada una necesita su propio
+# REPLICA para que los IDs no se repitan
+async def ejecutar_webhook(app):
+    async def recibir(request: Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return Response(status_code=403)
+        try:
+            update = Update.de_json(await request.json(), app.bot)
+        except Exception as e:
+            logger.warning(f"Actualización inválida recibida por webhook: {e}")
+            return Response(status_code=400)
+        await app.update_queue.put(update)
+        return Response()
+    
+    async def salud(request: Request):
+        return JSONResponse({
+            "estado": "ok",
+            "almacen": ALMACEN,
+            "conectado": cliente_sheets.libro is not None,
+            "altas_pendientes": len(diario_altas.pendientes),
+        })
+    
+    web = Starlette(routes=[
+        Route(f"/{RUTA_WEBHOOK}", recibir, methods=["POST"]),
+        Route("/salud", salud, methods=["GET"]),
+    ])
+    servidor = uvicorn.Server(uvicorn.Config(web, host="0.0.0.0", port=PUERTO, log_level="warning", lifespan="off"))
+    
+    # run_polling llama a estos ganchos por su cuenta; aquí hay que hacerlo a mano
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{RUTA_WEBHOOK}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await app.start()
+        logger.info(f"Webhook escuchando en el puerto {PUERTO}")
+        await servidor.serve()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
 
 # Función principal
-def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+def crear_app(request=None):
+    # Atender varias actualizaciones a la vez: una llamada lenta a Sheets ya no
+    # bloquea a los demás usuarios
+    constructor = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(ProcesadorPorChat(ACTUALIZACIONES_SIMULTANEAS))
+        .persistence(PersistenciaSQLite(RUTA_PERSISTENCIA))
+    )
+    if request:
+        # Para pruebas y benchmark.py: otra forma de hablar con la API de Telegram
+        constructor = constructor.request(request).get_updates_request(request)
+    app = constructor.build()
     
-    # Configurar comandos del menú
+    # Configurar comandos del menú y precargar las cachés
     async def set_commands(app):
+        await iniciar_servidor_metricas()
+        perfilador.iniciar()
+        # Conectar y precargar todo en paralelo para que el primer usuario no
+        # pague la espera; lo que falle aquí se reintenta en el primer uso
+        with contextlib.suppress(Exception):
+            await llamar_almacen(cliente_sheets.obtener_libro)
+        precargas = {
+            "índice de usuarios": registro_usuarios.cargar() if registro_usuarios else None,
+            "caché de ofertas": cache_ofertas.obtener() if cache_ofertas else None,
+            "caché de candidatos": cache_candidatos.obtener() if cache_candidatos else None,
+            "alertas": cargar_alertas(),
+        }
+        precargas = {nombre: tarea for nombre, tarea in precargas.items() if tarea}
+        resultados = await asyncio.gather(*precargas.values(), return_exceptions=True)
+        for nombre, resultado in zip(precargas, resultados):
+            if isinstance(resultado, Exception):
+                logger.error(f"Error precargando {nombre}: {resultado}")
         await app.bot.set_my_commands([
             ("start", "Iniciar el bot"),
             ("menu", "Mostrar menú"),
@@ -505,13 +3061,40 @@ def main():
             ("buscar", "Buscar ofertas"),
             ("buscoempleo", "Registrarse"),
             ("buscarcandidatos", "Buscar trabajadores"),
+            ("alerta", "Avisos de nuevas ofertas"),
+            ("misofertas", "Mis ofertas y sus candidatos"),
             ("cancelar", "Cancelar acción"),
             ("enviar", "Enviar mensaje masivo (admin)"),
+            ("cancelarenvio", "Cancelar envío masivo (admin)"),
+            ("stats", "Estadísticas (admin)"),
+            ("importar", "Importar ofertas o candidatos (admin)"),
+            ("exportar", "Exportar ofertas o candidatos (admin)"),
             ("ayuda", "Mostrar ayuda")
         ])
     
     app.post_init = set_commands
     
+    # Volcar el diario de altas y los registros de usuarios acumulados y, en
+    # modo SQLite, enviar los cambios pendientes a Sheets por lotes
+    async def volcar_al_parar(app):
+        await parar_servidor_metricas()
+        await drenar_diario(None)
+        if registro_usuarios:
+            await volcar_usuarios(None)
+        if isinstance(almacen, AlmacenSQLite):
+            await replicar_a_sheets(None)
+    
+    app.job_queue.run_repeating(drenar_diario, interval=INTERVALO_DIARIO, first=INTERVALO_DIARIO)
+    if registro_usuarios:
+        app.job_queue.run_repeating(volcar_usuarios, interval=INTERVALO_VOLCADO_USUARIOS, first=INTERVALO_VOLCADO_USUARIOS)
+    if isinstance(almacen, AlmacenSQLite):
+        app.job_queue.run_repeating(replicar_a_sheets, interval=INTERVALO_REPLICACION, first=INTERVALO_REPLICACION)
+    app.post_stop = volcar_al_parar
+    
+    # Eliminar las ofertas con más de DIAS_VIGENCIA_OFERTAS días
+    if ofertas_db:
+        app.job_queue.run_repeating(caducar_ofertas, interval=INTERVALO_CADUCIDAD, first=60)
+    
     # Configurar ConversationHandlers
     oferta_conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(iniciar_oferta, pattern="ofertar_trabajo")],
@@ -522,7 +3105,10 @@ def main():
             DESCRIPCION: [MessageHandler(filters.TEXT & ~filters.COMMAND, guardar_descripcion)],
             CONTACTO: [MessageHandler(filters.TEXT & ~filters.COMMAND, guardar_contacto)],
         },
-        fallbacks=[CommandHandler("cancelar", cancelar)]
+        fallbacks=[CommandHandler("cancelar", cancelar)],
+        name="oferta_conv",
+        persistent=True,
+        allow_reentry=True
     )
     
     registro_conv = ConversationHandler(
@@ -533,23 +3119,125 @@ def main():
             ESCOLARIDAD: [MessageHandler(filters.TEXT & ~filters.COMMAND, guardar_escolaridad)],
             CONTACTO_TRABAJADOR: [MessageHandler(filters.TEXT & ~filters.COMMAND, guardar_contacto_trabajador)],
         },
-        fallbacks=[CommandHandler("cancelar", cancelar)]
+        fallbacks=[CommandHandler("cancelar", cancelar)],
+        name="registro_conv",
+        persistent=True,
+        allow_reentry=True
     )
     
     # Handlers
+    app.add_handler(TypeHandler(Update, filtro_abuso), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("menu", menu))
     app.add_handler(CommandHandler("ayuda", ayuda))
     app.add_handler(CommandHandler("buscar", buscar_ofertas))
     app.add_handler(CommandHandler("buscarcandidatos", buscar_candidatos))
     app.add_handler(CommandHandler("cancelar", cancelar))
+    app.add_handler(CommandHandler("alerta", alerta))
+    app.add_handler(CommandHandler("misofertas", mis_ofertas))
     app.add_handler(CommandHandler("enviar", enviar_mensaje))
-    app.add_handler(CallbackQueryHandler(handle_button))
+    app.add_handler(CommandHandler("cancelarenvio", cancelar_envio))
+    app.add_handler(CommandHandler("stats", estadisticas))
+    app.add_handler(CommandHandler("exportar", exportar))
+    app.add_handler(CommandHandler("importar", importar))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/importar\b"), importar))
+    app.add_handler(InlineQueryHandler(consulta_inline))
+    # Las conversaciones van antes del manejador genérico de botones y son las
+    # únicas que atienden "ofertar_trabajo" y "registro_trabajador"; pulsarlos
+    # a mitad del formulario lo empieza de nuevo
     app.add_handler(oferta_conv)
     app.add_handler(registro_conv)
+    app.add_handler(CallbackQueryHandler(handle_button))
     
-    logger.info("Bot iniciado")
-    app.run_polling()
+    # Latencia de cada manejador y métricas que se calculan al consultarlas
+    for grupo in app.handlers.values():
+        for handler in grupo:
+            instrumentar(handler)
+    metricas.indicador(
+        "empleo_conversaciones_activas", "Altas de ofertas y candidatos en curso",
+        lambda: [({"tipo": tipo}, sum(1 for datos in app.user_data.values() if tipo in datos)) for tipo in ("oferta", "candidato")]
+    )
+    metricas.indicador(
+        "empleo_altas_pendientes", "Altas del diario aún no escritas en el almacenamiento",
+        lambda: [({}, len(diario_altas.pendientes))]
+    )
+    metricas.indicador(
+        "empleo_difusion_en_curso", "Difusiones masivas en curso",
+        lambda: [({}, 1 if app.bot_data.get('difusion') else 0)]
+    )
+    return app
+
+def main():
+    bloqueo = bloquear_diario()
+    if not bloqueo:
+        logger.error(f"Otro proceso está usando {DIARIO_ALTAS}; ¿el bot ya está en marcha?")
+        sys.exit(1)
+    if not 0 <= REPLICA < AsignadorIds.REPLICAS:
+        logger.error(f"REPLICA debe estar entre 0 y {AsignadorIds.REPLICAS - 1}")
+        sys.exit(1)
+    app = crear_app()
+    logger.info(f"Bot iniciado en modo {MODO}")
+    if MODO == "webhook":
+        asyncio.run(ejecutar_webhook(app))
+    else:
+        app.run_polling()
+
+# Línea de comandos para importar y exportar sin pasar por Telegram. Usa el
+# mismo almacenamiento y el mismo diario de altas que el bot: con el bot en
+# marcha no se toca el diario, así que importar se rechaza (los IDs se
+# repetirían) y exportar no incluye las altas que el bot aún no ha escrito
+async def transferir(argumentos):
+    formato = argumentos.formato or formato_de(argumentos.fichero)
+    if formato not in FORMATOS:
+        logger.error("No se reconoce el formato: usa un fichero .csv o .jsonl, o --formato")
+        return 2
+    if argumentos.tabla not in tablas_transferibles():
+        logger.error(f"El almacenamiento de {argumentos.tabla} no está disponible")
+        return 1
+    estandar = argumentos.fichero == "-"
+    bloqueo = bloquear_diario()
+    if bloqueo:
+        await drenar_diario(None)
+    elif argumentos.accion == "importar":
+        logger.error("El bot está en marcha: páralo antes de importar o usa /importar desde Telegram")
+        return 1
+    else:
+        logger.warning("El bot está en marcha: se exporta sin las altas que aún tiene pendientes")
+    if argumentos.accion == "exportar":
+        f = sys.stdout if estandar else open(argumentos.fichero, "w", encoding="utf-8", newline="")
+        try:
+            total = await exportar_registros(f, formato, argumentos.tabla)
+        finally:
+            if not estandar:
+                f.close()
+        logger.info(f"Exportación de {argumentos.tabla}: {total} filas")
+        return 0
+    f = sys.stdin if estandar else open(argumentos.fichero, encoding="utf-8-sig", newline="")
+    try:
+        resumen = await importar_registros(f, formato, argumentos.tabla)
+    finally:
+        if not estandar:
+            f.close()
+    for error in resumen["errores"]:
+        logger.warning(f"Fila rechazada, {error}")
+    if isinstance(almacen, AlmacenSQLite):
+        # Enviar ya las filas nuevas a Sheets en vez de esperar al próximo arranque
+        try:
+            while await llamar_almacen(almacen.replicar):
+                pass
+        except Exception as e:
+            logger.error(f"Error replicando a Sheets; se reintentará al arrancar el bot: {e}")
+    return 1 if resumen["fallo"] else 0
+
+def linea_de_comandos(args: list) -> int:
+    parser = argparse.ArgumentParser(prog="main.py", description="Importar o exportar ofertas y candidatos")
+    parser.add_argument("accion", choices=["importar", "exportar"])
+    parser.add_argument("tabla", choices=["ofertas", "candidatos"])
+    parser.add_argument("fichero", help="Fichero .csv o .jsonl; - para la entrada o salida estándar")
+    parser.add_argument("--formato", choices=FORMATOS, help="Por defecto, según la extensión del fichero")
+    return asyncio.run(transferir(parser.parse_args(args)))
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ("importar", "exportar"):
+        sys.exit(linea_de_comandos(sys.argv[1:]))
     main()
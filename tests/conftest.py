@@ -0,0 +1,13 @@
+# main.py lee la configuración al importarse: ficheros locales en una carpeta
+# temporal, compartida por todos los módulos de prueba
+import os
+import sys
+import tempfile
+
+_carpeta = tempfile.mkdtemp(prefix="test_empleo_")
+os.environ.setdefault("TELEGRAM_TOKEN", "0:test")
+os.environ["ALMACEN"] = "sheets"
+os.environ["DIARIO_ALTAS"] = os.path.join(_carpeta, "altas_pendientes.jsonl")
+os.environ["ARCHIVO_LOCAL_OFERTAS"] = os.path.join(_carpeta, "ofertas_archivadas.jsonl")
+os.environ["RUTA_PERSISTENCIA"] = os.path.join(_carpeta, "estado_bot.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,83 @@
+# Recuperación del diario de altas contra la hoja en memoria de benchmark.py
+import asyncio
+import json
+import time
+from collections import Counter
+
+import main as m
+from benchmark import LibroMemoria
+
+
+def crear_tabla():
+    cliente = m.ClienteSheets("prueba")
+    cliente.libro = LibroMemoria({"Ofertas": [m.ENCABEZADOS["Ofertas"]]}, 0, Counter())
+    return m.TablaSheets(cliente, "Ofertas"), cliente.libro.hojas["Ofertas"]
+
+
+def oferta(id_fila: int) -> list:
+    return [str(id_fila), f"puesto {id_fila}", "Empresa", "1000", "descripción", "tel", "2026-01-01", "1"]
+
+
+def ids_en(hoja) -> list:
+    return [fila[0] for fila in hoja.filas[1:]]
+
+
+def test_reinicio_no_repite_altas_ya_escritas(tmp_path):
+    ruta = str(tmp_path / "altas.jsonl")
+    tabla, hoja = crear_tabla()
+    filas = [oferta(i) for i in (101, 102, 103)]
+
+    async def registrar():
+        diario = m.DiarioAltas(ruta)
+        for fila in filas:
+            await diario.registrar("Ofertas", fila)
+
+    asyncio.run(registrar())
+    # El proceso cayó con las dos primeras ya escritas pero sin confirmar, y
+    # con una última línea a medio escribir
+    hoja.filas.extend(list(fila) for fila in filas[:2])
+    with open(ruta, "a", encoding="utf-8") as f:
+        f.write('{"alta": 4, "tabla": "Ofer')
+
+    diario = m.DiarioAltas(ruta)
+    assert len(diario.pendientes) == 3 and diario.verificar
+    asyncio.run(diario.drenar({"Ofertas": tabla}))
+
+    assert ids_en(hoja) == ["101", "102", "103"]
+    assert not diario.pendientes and not diario.verificar
+    # El fichero queda compactado: un nuevo arranque no tiene nada pendiente
+    with open(ruta, encoding="utf-8") as f:
+        assert [json.loads(linea) for linea in f] == [{"ultimos": {"Ofertas": 103}}]
+    reinicio = m.DiarioAltas(ruta)
+    assert not reinicio.pendientes and reinicio.ultimos == {"Ofertas": 103}
+
+
+def test_escritura_tras_timeout_no_se_repite(tmp_path, monkeypatch):
+    monkeypatch.setattr(m, "SHEETS_TIMEOUT", 0.05)
+    tabla, hoja = crear_tabla()
+    agregar = hoja.append_rows
+
+    def agregar_lento(filas, **kwargs):
+        # Sheets responde después del timeout, pero la escritura llega
+        time.sleep(0.3)
+        return agregar(filas, **kwargs)
+
+    hoja.append_rows = agregar_lento
+
+    async def drenar():
+        diario = m.DiarioAltas(str(tmp_path / "altas.jsonl"))
+        await diario.registrar("Ofertas", oferta(7))
+        await diario.drenar({"Ofertas": tabla})
+        assert diario.pendientes and diario.verificar
+        # Reintento mientras la escritura sigue en su hilo: no hace nada
+        diario.proximo_intento = 0
+        await diario.drenar({"Ofertas": tabla})
+        assert ids_en(hoja) == []
+        await asyncio.wrap_future(diario.escritura)
+        diario.proximo_intento = 0
+        await diario.drenar({"Ofertas": tabla})
+        return diario
+
+    diario = asyncio.run(drenar())
+    assert ids_en(hoja) == ["7"]
+    assert not diario.pendientes
@@ -0,0 +1,94 @@
+# Motor de difusión contra un bot falso que simula los límites de Telegram
+import asyncio
+import time
+from collections import Counter
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import main as m
+
+
+class BotFalso:
+    # Cada chat puede tener una lista de errores que se lanzan, en orden, en
+    # sus primeros intentos; después el envío se entrega
+    def __init__(self, errores: dict = None, latencia: float = 0.0):
+        self.errores = {chat: list(lista) for chat, lista in (errores or {}).items()}
+        self.latencia = latencia
+        self.intentos = Counter()
+        self.momentos = []  # (momento, chat_id) de cada intento
+        self.entregados = []
+
+    async def send_message(self, chat_id: int, text: str):
+        self.intentos[chat_id] += 1
+        self.momentos.append((time.monotonic(), chat_id))
+        if self.errores.get(chat_id):
+            raise self.errores[chat_id].pop(0)
+        await asyncio.sleep(self.latencia)
+        self.entregados.append(chat_id)
+
+
+def difundir(bot: BotFalso, destinos: list, **opciones) -> m.Difusion:
+    limitador = m.LimitadorEnvios(tasa_global=1000, intervalo_chat=0)
+    difusion = m.Difusion(bot, destinos, "hola", limitador, **opciones)
+    asyncio.run(difusion.ejecutar())
+    return difusion
+
+
+def test_retry_after_pausa_todos_los_envios():
+    bot = BotFalso({3: [RetryAfter(1)]})
+    inicio = time.monotonic()
+    difusion = difundir(bot, list(range(1, 11)), simultaneos=2)
+
+    assert sorted(bot.entregados) == list(range(1, 11))
+    assert bot.intentos[3] == 2
+    assert time.monotonic() - inicio >= 1
+    # Tras el RetryAfter nadie vuelve a intentar hasta que pasa la pausa
+    limitado = next(t for t, chat in bot.momentos if chat == 3)
+    posteriores = [t for t, _ in bot.momentos if t > limitado]
+    assert posteriores and min(posteriores) - limitado >= 0.95
+    assert difusion.enviados == 10 and difusion.fallidos == 0
+
+
+def test_reintentos_limitados():
+    bot = BotFalso({1: [RetryAfter(0)] * 10, 2: [RetryAfter(0)]})
+    difusion = difundir(bot, [1, 2, 3], max_reintentos=2)
+
+    assert bot.intentos[1] == 3  # primer intento + 2 reintentos
+    assert bot.intentos[2] == 2
+    assert sorted(bot.entregados) == [2, 3]
+    assert difusion.enviados == 2 and difusion.fallidos == 1
+    assert difusion.bloqueados == []
+
+
+def test_bloqueados_no_se_reintentan():
+    bot = BotFalso({
+        2: [Forbidden("Forbidden: bot was blocked by the user")],
+        4: [BadRequest("Chat not found")],
+    })
+    difusion = difundir(bot, [1, 2, 3, 4])
+
+    assert sorted(difusion.bloqueados) == [2, 4]
+    assert bot.intentos[2] == 1 and bot.intentos[4] == 1
+    assert difusion.enviados == 2 and difusion.fallidos == 2
+    assert "2 marcados como inactivos" in difusion.resumen()
+
+
+def test_cancelar_detiene_la_difusion():
+    bot = BotFalso(latencia=0.01)
+    limitador = m.LimitadorEnvios(tasa_global=1000, intervalo_chat=0)
+    difusion = m.Difusion(bot, list(range(200)), "hola", limitador, simultaneos=4)
+
+    async def ejecutar():
+        tarea = asyncio.create_task(difusion.ejecutar())
+        while len(bot.entregados) < 20:
+            await asyncio.sleep(0.005)
+        difusion.cancelar()
+        intentos = sum(bot.intentos.values())
+        await tarea
+        return intentos
+
+    intentos_al_cancelar = asyncio.run(ejecutar())
+    # Solo terminan los envíos que ya estaban en curso
+    assert sum(bot.intentos.values()) == intentos_al_cancelar
+    assert difusion.procesados < 200
+    assert f"({200 - difusion.procesados} sin enviar)" in difusion.resumen()
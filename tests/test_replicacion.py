@@ -0,0 +1,89 @@
+# Cola de replicación de SQLite contra la hoja en memoria de benchmark.py
+import random
+from collections import Counter
+
+import main as m
+from benchmark import LibroMemoria
+
+
+def crear_almacen(tmp_path, filas: int = 20):
+    encabezados = m.ENCABEZADOS["Ofertas"]
+    ofertas = [encabezados] + [
+        [str(i), f"puesto {i}", "Empresa", "1000", "descripción", "tel", "2026-01-01", str(i % 12)]
+        for i in range(1, filas + 1)
+    ]
+    cliente = m.ClienteSheets("prueba")
+    cliente.libro = LibroMemoria({"Ofertas": ofertas}, 0, Counter())
+    almacen = m.AlmacenSQLite(str(tmp_path / "empleo.db"), m.AlmacenSheets(cliente))
+    return almacen, cliente.libro.hojas["Ofertas"]
+
+
+def replicar_todo(almacen) -> int:
+    total = 0
+    while lote := almacen.replicar():
+        total += lote
+    return total
+
+
+def test_sqlite_y_hoja_coinciden_tras_cambios_intercalados(tmp_path):
+    almacen, hoja = crear_almacen(tmp_path)
+    tabla = almacen.tabla("Ofertas")
+    aleatorio = random.Random(7)
+    siguiente = 100
+    for paso in range(300):
+        filas = len(tabla.leer_todo()) - 1
+        operacion = aleatorio.choice(["agregar", "agregar", "actualizar", "borrar", "borrar_donde", "replicar"])
+        if operacion == "agregar":
+            nuevas = []
+            for _ in range(aleatorio.randint(1, 3)):
+                siguiente += 1
+                nuevas.append([str(siguiente), f"puesto {siguiente}", "Otra", "2000", "texto", "tel", "2026-02-02", str(siguiente % 12)])
+            tabla.agregar_filas(nuevas)
+        elif operacion == "actualizar" and filas:
+            tabla.actualizar_celdas([(aleatorio.randint(2, filas + 1), 4, str(paso))])
+        elif operacion == "borrar" and filas:
+            inicio = aleatorio.randint(2, filas + 1)
+            rangos = [(inicio, min(filas + 1, inicio + aleatorio.randint(0, 2)))]
+            if inicio > 3:
+                rangos.append((2, 2))
+            tabla.borrar_rangos(rangos)
+        elif operacion == "borrar_donde":
+            tabla.borrar_donde(8, str(aleatorio.randint(0, 11)))
+        elif operacion == "replicar" and aleatorio.random() < 0.5:
+            # Solo un lote: el resto queda en la cola para después
+            almacen.replicar()
+        elif operacion == "replicar":
+            replicar_todo(almacen)
+            assert hoja.filas == tabla.leer_todo()
+    replicar_todo(almacen)
+
+    assert hoja.filas == tabla.leer_todo()
+    assert almacen.conn.execute("SELECT COUNT(*) FROM replicacion").fetchone()[0] == 0
+
+
+def test_replicar_agrupa_altas_consecutivas(tmp_path):
+    almacen, hoja = crear_almacen(tmp_path, filas=2)
+    tabla = almacen.tabla("Ofertas")
+    for i in range(5):
+        tabla.agregar_filas([[str(10 + i), "p", "e", "1", "d", "c", "2026-01-01", "1"]])
+    tabla.actualizar_celdas([(2, 2, "cambiado")])
+    hoja.llamadas.clear()
+
+    assert almacen.replicar() == 5
+    assert hoja.llamadas["append_rows"] == 1
+    assert almacen.replicar() == 1
+    assert almacen.replicar() == 0
+    assert hoja.filas == tabla.leer_todo()
+
+
+def test_replicar_en_curso_no_se_repite(tmp_path):
+    almacen, hoja = crear_almacen(tmp_path, filas=2)
+    tabla = almacen.tabla("Ofertas")
+    tabla.agregar_filas([["50", "p", "e", "1", "d", "c", "2026-01-01", "1"]])
+    # Otra réplica sigue en su hilo tras un timeout: esta no envía nada
+    with almacen.replicando:
+        assert almacen.replicar() == 0
+    assert [fila[0] for fila in hoja.filas].count("50") == 0
+
+    assert replicar_todo(almacen) == 1
+    assert [fila[0] for fila in hoja.filas].count("50") == 1